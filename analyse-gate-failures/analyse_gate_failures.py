@@ -1,13 +1,45 @@
 #!/usr/bin/env python3.5
 import argparse
+import codecs
 import collections
+from concurrent import futures
+import csv
 import datetime
 import json
+import re
+import sqlite3
 
 import requests
 
+GERRIT_URL = "https://review.openstack.org"
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 SINCE = datetime.date.today() - datetime.timedelta(days=30)
+# Number of changes requested per page. Gerrit caps it to the query limit of
+# the user anyway, and tells with `_more_changes` that there are more.
+PAGE_SIZE = 500
+# Shared by all the threads, so that connections are reused.
+SESSION = None
+# Gerrit prepends this to its JSON responses, to prevent XSSI.
+MAGIC_PREFIX = ")]}'"
+# Bytes read at once from a streamed response.
+CHUNK_SIZE = 64 * 1024
+JSON_DECODER = json.JSONDecoder()
+# What may separate two items of a JSON array.
+ITEM_SEPARATOR = re.compile(r'[\s,]*')
+# What may follow an item of a JSON array.
+ITEM_END = ' \t\n\r,]'
+# A job result line of a Gate failure comment, like
+# "- gate-tempest-dsvm-full http://logs... : FAILURE in 1h 02m 03s". It
+# starts with a literal newline rather than with `^`, so that the regex engine
+# can skip to the next line without trying each character, which makes it
+# faster than splitting the lines. The first line of a comment is always its
+# "Patch Set N: ..." header.
+JOB_RESULT = re.compile(r'\n[*-] ([^ \n]*) (?:[^ \n]+ )?: (SUCCESS|FAILURE)')
+# Jobs that ran less than this number of times are not displayed.
+MIN_RUNS = 10
+# Changes updated in the last minutes before a sync are queried again by the
+# next one, in case the clocks of Gerrit and ours slightly differ.
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
 
 
 def parse_args():
@@ -15,10 +47,46 @@ def parse_args():
         description='Print which jobs are responsible for Gate failures',
     )
 
-    parser.add_argument('--project', required=True,
-                        help='Project for which to analyse Gate failures.')
-
-    return parser.parse_args()
+    parser.add_argument('--project', action='append', default=[],
+                        help='Project for which to analyse Gate failures. '
+                             'Can be repeated.')
+    parser.add_argument('--projects-file', metavar='PATH',
+                        help='File with one project per line for which to '
+                             'analyse Gate failures.')
+    parser.add_argument('--project-regex', metavar='REGEX',
+                        help='Analyse Gate failures for all the projects '
+                             'whose name matches this regex.')
+    parser.add_argument('--slices', type=int, default=1,
+                        help='Split the last 30 days in this number of time '
+                             'slices, queried concurrently. (default: 1)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Maximum number of concurrent queries. '
+                             '(default: 8)')
+    parser.add_argument('--cache', metavar='PATH',
+                        help='SQLite database where the changes and their '
+                             'messages are kept. Only the changes updated '
+                             'since the previous run are queried, and the '
+                             'analysis runs from the database.')
+    parser.add_argument('--offline', action='store_true',
+                        help='Do not query Gerrit, only analyse what is in '
+                             '--cache.')
+    parser.add_argument('--bucket', choices=['day', 'week'],
+                        help='Also show the failure rate of the jobs per day '
+                             'or per week.')
+    parser.add_argument('--csv', metavar='PATH',
+                        help='Write the failure rate of the jobs of each '
+                             'project per --bucket to this CSV file, e.g to '
+                             'chart them.')
+
+    args = parser.parse_args()
+    if args.offline and not args.cache:
+        parser.error('--offline requires --cache')
+    if args.csv and not args.bucket:
+        parser.error('--csv requires --bucket')
+    if not (args.project or args.projects_file or args.project_regex):
+        parser.error('at least one of --project, --projects-file and '
+                     '--project-regex is required')
+    return args
 
 
 # This represents a Gerrit comment
@@ -27,42 +95,349 @@ Comment = collections.namedtuple(
 )
 
 
-def get_changes_of_interest(project):
-    """For a given project, get the Gerrit changes of interest.
+def create_session(pool_size):
+    """Create a HTTP session able to keep `pool_size` connections."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def list_projects(regex):
+    """Return the names of the projects matching a regex."""
+    r = SESSION.get(GERRIT_URL + '/projects/', params={'r': regex})
+    r.raise_for_status()
+    return sorted(json.loads(r.text[4:]))
 
-    For a given project, get all the recent changes where at least one
-    Gate failure happened.
+
+def get_projects(args, store=None):
+    """Return the projects to analyse, from all the options that set them.
+
+    Offline, the regex is matched against the projects of the store instead
+    of the projects of Gerrit.
     """
-    search = ('reviewer:"Jenkins" AND comment:"Verified-2"'
-              'AND project:"%s" AND since:%s' % (project, SINCE))
+    projects = list(args.project)
+    if args.projects_file:
+        with open(args.projects_file) as projects_file:
+            projects.extend(
+                line.strip() for line in projects_file
+                if line.strip() and not line.startswith('#')
+            )
+    if args.project_regex and args.offline:
+        projects.extend(project for project in store.get_projects()
+                        if re.fullmatch(args.project_regex, project))
+    elif args.project_regex:
+        projects.extend(list_projects(args.project_regex))
+    # Remove duplicates but keep the order
+    return list(collections.OrderedDict.fromkeys(projects))
 
-    # Include review messages in query
-    query = ("https://review.openstack.org/changes/?q=%s&"
-             "o=MESSAGES&o=DETAILED_ACCOUNTS" % search)
-    r = requests.get(query)
-    return json.loads(r.text[4:])
+
+def iter_text(response):
+    """Yield the body of a streamed response, decoded chunk by chunk."""
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    for chunk in response.iter_content(CHUNK_SIZE):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+def iter_json_array(chunks):
+    """Yield the items of a JSON array, decoded from text chunks.
+
+    Only the item being decoded is kept in memory, instead of the whole
+    document. Gerrit's magic prefix before the array is skipped.
+    """
+    chunks = iter(chunks)
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        pos = buffer.find('[')
+        if pos != -1:
+            break
+    else:
+        raise ValueError('No JSON array found')
+    if buffer[:pos].strip() not in ('', MAGIC_PREFIX):
+        raise ValueError('Unexpected data before the JSON array')
+
+    pos += 1
+    # An item that is not complete yet is only decoded again once the
+    # buffer doubled, so that a large item is not decoded once per chunk.
+    retry_at = 0
+    exhausted = False
+    while True:
+        pos = ITEM_SEPARATOR.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        if pos < len(buffer) and (len(buffer) >= retry_at or exhausted):
+            try:
+                item, end = JSON_DECODER.raw_decode(buffer, pos)
+            except ValueError:
+                retry_at = pos + 2 * (len(buffer) - pos)
+            else:
+                # A number cut by the end of a chunk is decoded as a shorter
+                # number: an item is only complete once what follows it is
+                # known.
+                if (exhausted or
+                        (end < len(buffer) and buffer[end] in ITEM_END)):
+                    yield item
+                    pos = end
+                    continue
+                retry_at = len(buffer) + 1
+        if exhausted:
+            raise ValueError('Invalid or truncated JSON array')
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+        else:
+            buffer = buffer[pos:] + chunk
+            retry_at -= pos
+            pos = 0
+
+
+def is_gate_failure(msg):
+    """Tell whether a review message reports a Gate failure."""
+    return (msg.get('author', {}).get('name') == 'Jenkins' and
+            'Verified-2' in msg['message'])
+
+
+def get_changes_page(search, start):
+    """Yield one page of the changes matching a search, with their Gate
+    failure messages.
+
+    The response is parsed while it is downloaded and the other messages are
+    dropped as soon as a change is parsed, so that a large page is never held
+    in memory.
+    """
+    params = {
+        'q': search,
+        # Include review messages in query
+        'o': ['MESSAGES', 'DETAILED_ACCOUNTS'],
+        'n': PAGE_SIZE,
+        'S': start,
+    }
+    with SESSION.get(GERRIT_URL + '/changes/', params=params,
+                     stream=True) as r:
+        r.raise_for_status()
+        for change in iter_json_array(iter_text(r)):
+            change['messages'] = [msg for msg in change.get('messages', [])
+                                  if is_gate_failure(msg)]
+            yield change
+
+
+def iter_changes(search):
+    """Yield all the changes matching a search, page after page."""
+    start = 0
+    while True:
+        change = None
+        for change in get_changes_page(search, start):
+            start += 1
+            yield change
+
+        if change is None or not change.get('_more_changes'):
+            return
+
+
+def get_time_slices(since, until, count):
+    """Split [since, until) in `count` slices of the same duration."""
+    step = (until - since) / count
+    bounds = [since + step * i for i in range(count)] + [until]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def get_changes_of_interest(project, slices=1, workers=8, since=None):
+    """For a given project, yield the Gerrit changes of interest.
+
+    For a given project, yield all the recent changes where at least one
+    Gate failure happened, or the ones updated after `since` (a datetime).
+
+    With several `slices`, the period is split in as many time slices, whose
+    changes are queried concurrently and then merged. A change that is
+    updated while it is being queried may show up in two slices, it is only
+    yielded once.
+    """
+    search = ('reviewer:"Jenkins" AND comment:"Verified-2" '
+              'AND project:"%s"' % project)
+    if since is None:
+        since = datetime.datetime.combine(SINCE, datetime.time())
+    if slices <= 1:
+        yield from iter_changes('%s AND since:"%s"' % (
+            search, since.strftime(TIME_FORMAT)))
+        return
+
+    until = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    slice_searches = [
+        '%s AND after:"%s" AND before:"%s"' % (
+            search, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))
+        for start, end in get_time_slices(since, until, slices)
+    ]
+
+    seen = set()
+    with futures.ThreadPoolExecutor(workers) as executor:
+        for slice_changes in executor.map(
+                lambda slice_search: list(iter_changes(slice_search)),
+                slice_searches):
+            for change in slice_changes:
+                if change['_number'] not in seen:
+                    seen.add(change['_number'])
+                    yield change
+
+
+def parse_timestamp(timestamp):
+    """Parse a Gerrit timestamp, several times faster than strptime.
+
+    https://review.openstack.org/Documentation/rest-api.html#timestamp
+    The nanoseconds are dropped.
+    """
+    return datetime.datetime(
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])
+    )
 
 
 def get_all_gate_failures_for_change(change):
     """For a given change, yields all the gate failure comments."""
     for msg in change['messages']:
-        if 'author' not in msg or msg['author']['name'] != 'Jenkins':
+        if not is_gate_failure(msg):
             continue
 
-        if 'Verified-2' not in msg['message']:
-            continue
-
-        # https://review.openstack.org/Documentation/rest-api.html#timestamp
-        date = msg['date'].split('.')[0]  # drop nanoseconds
-        date = datetime.datetime.strptime(date, TIME_FORMAT)
-        yield date, msg['message']
-
-
-def get_all_gate_failures_for_project(project):
-    """For a given project, returns all the gate failure comments."""
+        yield parse_timestamp(msg['date']), msg['message']
+
+
+class ChangeStore(object):
+    """SQLite database of the changes of interest and of their messages."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS changes (
+                number INTEGER PRIMARY KEY,
+                project TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                updated TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS changes_project_updated
+                ON changes (project, updated);
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                change_number INTEGER NOT NULL REFERENCES changes (number),
+                author TEXT,
+                date TEXT NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_change_number
+                ON messages (change_number);
+            CREATE TABLE IF NOT EXISTS syncs (
+                project TEXT PRIMARY KEY,
+                synced_at TEXT NOT NULL
+            );
+        """)
+
+    def get_last_sync(self, project):
+        """Return when the changes of a project were last synced, or None."""
+        row = self.db.execute(
+            "SELECT synced_at FROM syncs WHERE project = ?", (project,)
+        ).fetchone()
+        return datetime.datetime.strptime(row[0], TIME_FORMAT) if row else None
+
+    def get_projects(self):
+        """Return the projects that were synced at least once."""
+        return [row[0] for row in self.db.execute(
+            "SELECT project FROM syncs ORDER BY project")]
+
+    def add_changes(self, project, changes, synced_at):
+        """Insert or update changes and their messages, in one transaction.
+
+        Return the number of changes.
+        """
+        count = 0
+        with self.db:
+            for change in changes:
+                count += 1
+                self.db.execute(
+                    "INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?)",
+                    (change['_number'], project, change['subject'],
+                     change['updated'])
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                    [(msg['id'], change['_number'],
+                      msg.get('author', {}).get('name'), msg['date'],
+                      msg['message'])
+                     for msg in change['messages']]
+                )
+            self.db.execute(
+                "INSERT OR REPLACE INTO syncs VALUES (?, ?)",
+                (project, synced_at.strftime(TIME_FORMAT))
+            )
+        return count
+
+    def sync(self, projects, slices=1, workers=8):
+        """Fetch the changes updated since the last sync of some projects.
+
+        Projects are queried concurrently, but their changes are added from
+        the calling thread, the only one allowed to use the database.
+        """
+        synced_at = datetime.datetime.utcnow()
+        sinces = {}
+        for project in projects:
+            last_sync = self.get_last_sync(project)
+            sinces[project] = last_sync - SYNC_OVERLAP if last_sync else None
+
+        def fetch(project):
+            return list(get_changes_of_interest(project, slices, workers,
+                                                sinces[project]))
+
+        fetched = 0
+        with futures.ThreadPoolExecutor(workers) as executor:
+            fetches = {executor.submit(fetch, project): project
+                       for project in projects}
+            for future in futures.as_completed(fetches):
+                fetched += self.add_changes(fetches[future], future.result(),
+                                            synced_at)
+        return fetched
+
+    def get_changes(self, project, since):
+        """Yield the changes of a project updated since a date, in the same
+        format as the Gerrit API, with their messages.
+        """
+        changes = self.db.execute(
+            "SELECT number, subject FROM changes "
+            "WHERE project = ? AND updated >= ?",
+            (project, since.strftime(TIME_FORMAT))
+        ).fetchall()
+        for number, subject in changes:
+            messages = self.db.execute(
+                "SELECT author, date, message FROM messages "
+                "WHERE change_number = ?", (number,)
+            )
+            yield {
+                '_number': number,
+                'subject': subject,
+                'messages': [
+                    {'author': {'name': author}, 'date': date,
+                     'message': message}
+                    if author is not None else
+                    {'date': date, 'message': message}
+                    for author, date, message in messages
+                ],
+            }
+
+
+def get_all_gate_failures_for_project(project, slices=1, workers=8,
+                                      store=None):
+    """For a given project, returns all the gate failure comments.
+
+    With a `store`, the changes are read from it instead of being queried.
+    """
     gate_failure_comments = []
 
-    for change in get_changes_of_interest(project):
+    if store is not None:
+        changes = store.get_changes(project, SINCE)
+    else:
+        changes = get_changes_of_interest(project, slices, workers)
+
+    for change in changes:
         for date, message in get_all_gate_failures_for_change(change):
             gate_failure_comments.append(
                 Comment(date, change['_number'], change['subject'], message)
@@ -74,52 +449,168 @@ def get_all_gate_failures_for_project(project):
 
 
 def compute_stats_per_job(comment, stats):
-    """Given a Gate failure comment, extract which job(s) failed."""
-    for line in comment.message.splitlines():
-        if line.startswith("* ") or line.startswith("- "):
-            job = line.split(' ')[1]
+    """Given a Gate failure comment, count which job(s) failed."""
+    for match in JOB_RESULT.finditer(comment.message):
+        job, result = match.groups()
+        if job not in stats:
+            stats[job] = {'ok': 0, 'ko': 0}
+        stats[job]['ok' if result == 'SUCCESS' else 'ko'] += 1
 
-            # If this is the first time we see this job then init the stats
-            if job not in stats:
-                stats[job] = {'ok': 0, 'ko': 0, 'ko_rate': 0}
 
-            if " : SUCCESS" in line or " : FAILURE" in line:
-                if " : SUCCESS" in line:
-                    stats[job]['ok'] += 1
-                elif " : FAILURE" in line:
-                    stats[job]['ko'] += 1
+def get_ko_rate(job_stats):
+    """Return the failure rate of a job, in percent."""
+    return job_stats['ko'] / (job_stats['ok'] + job_stats['ko']) * 100
 
-                stats[job]['ko_rate'] = (stats[job]['ko'] / (
-                    stats[job]['ko'] + stats[job]['ok'])) * 100
 
+def get_bucket(date, bucket):
+    """Return the first day of the day or of the week of a date."""
+    if bucket == 'week':
+        return date.date() - datetime.timedelta(days=date.weekday())
+    return date.date()
 
-def main():
-    args = parse_args()
 
-    # Dict of job_name => job_statistics
-    jobs_stats = collections.defaultdict(dict)
+def compute_stats_per_bucket(gate_failure_comments, bucket):
+    """Return the statistics of the jobs of each day or week."""
+    # Dict of bucket => job_name => job_statistics
+    buckets_stats = collections.defaultdict(dict)
+    for gate_failure_comment in gate_failure_comments:
+        compute_stats_per_job(
+            gate_failure_comment,
+            buckets_stats[get_bucket(gate_failure_comment.date, bucket)]
+        )
+    return buckets_stats
 
-    gate_failure_comments = get_all_gate_failures_for_project(args.project)
-    print("Jenkins left %d 'Verified-2' messages on project %s" % (
-        len(gate_failure_comments), args.project))
+
+def print_jobs_stats(gate_failure_comments):
+    """Print the failure rate of the jobs of some Gate failure comments.
+
+    Return the names of the jobs displayed, in the same order.
+    """
+    # Dict of job_name => job_statistics
+    jobs_stats = {}
 
     for gate_failure_comment in gate_failure_comments:
         compute_stats_per_job(gate_failure_comment, jobs_stats)
 
-    print("Note: the statistics don't show the absolute failure rate of a "
-          "given job, but the failure rate knowing there's a Gate failure "
-          "(i.e we don't account for changes where everything went smooth)")
-    print("Note: jobs that ran less than 10 times are not displayed here.")
-
+    job_names = []
     for job_name, job_stats in sorted(
-            jobs_stats.items(), key=lambda x: x[1]['ko_rate'], reverse=True
+            jobs_stats.items(), key=lambda x: get_ko_rate(x[1]), reverse=True
     ):
         # If we don"t have enough data to display relevant stats.
-        if job_stats.get('ok', 0) + job_stats.get('ko', 0) < 10:
+        if job_stats['ok'] + job_stats['ko'] < MIN_RUNS:
             continue
 
-        print("{job_name:60} {ko_rate:04.1f}% "
-              "({ok}/{ko})".format(job_name=job_name, **jobs_stats[job_name]))
+        job_names.append(job_name)
+        print("{job_name:60} {ko_rate:04.1f}% ({ok}/{ko})".format(
+            job_name=job_name, ko_rate=get_ko_rate(job_stats), **job_stats))
+    return job_names
+
+
+def print_jobs_stats_per_bucket(buckets_stats, bucket, job_names):
+    """Print the failure rate of some jobs per day or per week, one column
+    per day or week, from the first one to the last one.
+    """
+    if not buckets_stats:
+        return
+    step = datetime.timedelta(days=7 if bucket == 'week' else 1)
+    buckets = [min(buckets_stats)]
+    while buckets[-1] < max(buckets_stats):
+        buckets.append(buckets[-1] + step)
+
+    print("{:60}".format("Failure rate per %s" % bucket) + "".join(
+        " {:>6}".format(start.strftime('%m-%d')) for start in buckets))
+    for job_name in job_names:
+        cells = []
+        for start in buckets:
+            job_stats = buckets_stats.get(start, {}).get(job_name)
+            cells.append(" {:5.1f}%".format(get_ko_rate(job_stats))
+                         if job_stats else " {:>6}".format("-"))
+        print("{:60}".format(job_name) + "".join(cells))
+
+
+def write_stats_per_bucket(writer, project, buckets_stats):
+    """Write the statistics of the jobs of each day or week as CSV rows."""
+    for start, jobs_stats in sorted(buckets_stats.items()):
+        for job_name, job_stats in sorted(jobs_stats.items()):
+            writer.writerow([
+                project, start.isoformat(), job_name, job_stats['ok'],
+                job_stats['ko'], "%.1f" % get_ko_rate(job_stats)
+            ])
+
+
+def main():
+    global SESSION
+
+    args = parse_args()
+    # Projects and the time slices of each project are queried concurrently
+    SESSION = create_session(args.workers * max(args.slices, 1))
+
+    store = None
+    if args.cache:
+        store = ChangeStore(args.cache)
+    projects = get_projects(args, store)
+
+    if store is not None:
+        if not args.offline:
+            print("Fetched %d changes updated since the last sync" % (
+                store.sync(projects, args.slices, args.workers)))
+        comments_per_project = {
+            project: get_all_gate_failures_for_project(
+                project, store=store)
+            for project in projects
+        }
+    else:
+        with futures.ThreadPoolExecutor(args.workers) as executor:
+            comments_per_project = dict(zip(projects, executor.map(
+                lambda project: get_all_gate_failures_for_project(
+                    project, args.slices, args.workers),
+                projects)))
+
+    print("Note: the statistics don't show the absolute failure rate of a "
+          "given job, but the failure rate knowing there's a Gate failure "
+          "(i.e we don't account for changes where everything went smooth)")
+    print("Note: jobs that ran less than %d times are not displayed here." % (
+        MIN_RUNS))
+
+    csv_file = open(args.csv, 'w', newline='') if args.csv else None
+    if csv_file is not None:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(['project', args.bucket, 'job', 'ok', 'ko',
+                             'ko_rate'])
+
+    for project in projects:
+        gate_failure_comments = comments_per_project[project]
+        print()
+        print("Jenkins left %d 'Verified-2' messages on project %s" % (
+            len(gate_failure_comments), project))
+        job_names = print_jobs_stats(gate_failure_comments)
+
+        if args.bucket:
+            buckets_stats = compute_stats_per_bucket(gate_failure_comments,
+                                                     args.bucket)
+            print()
+            print_jobs_stats_per_bucket(buckets_stats, args.bucket,
+                                        job_names)
+            if csv_file is not None:
+                write_stats_per_bucket(csv_writer, project, buckets_stats)
+
+    if csv_file is not None:
+        csv_file.close()
+
+    if len(projects) > 1:
+        all_comments = [comment
+                        for project in projects
+                        for comment in comments_per_project[project]]
+        print()
+        print("Jenkins left %d 'Verified-2' messages on the %d projects" % (
+            len(all_comments), len(projects)))
+        job_names = print_jobs_stats(all_comments)
+
+        if args.bucket:
+            print()
+            print_jobs_stats_per_bucket(
+                compute_stats_per_bucket(all_comments, args.bucket),
+                args.bucket, job_names)
 
 
 if __name__ == '__main__':
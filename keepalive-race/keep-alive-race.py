@@ -1,20 +1,39 @@
 #!/usr/bin/python3
 """
 This script demonstrates a race condition with HTTP/1.1 keepalive
+
+Each worker repeatedly waits for an idle delay then reuses its keep-alive
+connection to GET a URL. If the server (or a load balancer in front of it)
+closes idle connections after a timeout close to that delay, some requests
+fail. The delays are swept over a range and the failure rate and latency
+percentiles are reported for each of them, which tells the keep-alive
+timeout of any API endpoint and how the client copes with it.
+
+Examples:
+
+    $ ./keep-alive-race.py --os-cloud devstack \\
+          'https://10.0.1.44:8774/v2/{project_id}/servers/detail' --insecure
+    $ ./keep_alive_server.py --idle-timeout 5 --close-delay 0.05 &
+    $ ./keep-alive-race.py http://127.0.0.1:8774/ --mode asyncio \\
+          --delay-start 4.9 --delay-stop 5.1 --delay-step 0.05
 """
+import argparse
+import collections
 import decimal
 import json
 import subprocess
-import time
 import threading
+import time
 
 import requests
-requests.packages.urllib3.disable_warnings()
 
-CREDS = json.loads(subprocess.check_output(
-    "openstack --os-cloud devstack token issue -f json".split(),
-).decode())
-URL = 'https://10.0.1.44:8774/v2/%s/servers/detail' % (CREDS['project_id'])
+# `reused` is False for the first request of a connection, which is not
+# sent on an idle connection and therefore tells nothing about the race.
+# `idle` is how long the connection actually stayed idle before the request,
+# measured from the end of the previous response.
+Result = collections.namedtuple(
+    'Result', ['delay', 'reused', 'idle', 'ok', 'latency', 'error']
+)
 
 
 def decimal_range(x, y, jump):
@@ -26,37 +45,303 @@ def decimal_range(x, y, jump):
         x += jump
 
 
-def get(exit):
-    for delay in decimal_range(4.95, 4.96, 0.005):
-        session = requests.Session()
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float('nan')
+    rank = max(int(round(percent / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+class RateLimiter(object):
+    """Spread the requests of all the workers to at most `rate` per second.
+
+    It only computes how long a caller must wait, so the same instance can
+    be shared by threads or by coroutines.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.next_slot - now, 0.0)
+            self.next_slot = max(self.next_slot, now) + self.interval
+        return wait
+
+
+def get_token(cloud):
+    return json.loads(subprocess.check_output(
+        ["openstack", "--os-cloud", cloud, "token", "issue", "-f", "json"]
+    ).decode())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Reuse idle HTTP/1.1 keep-alive connections after "
+                    "various delays and report the failure rate per delay.")
+    parser.add_argument("url",
+                        help="URL to GET. '{project_id}' is replaced by the "
+                             "project of the token when --os-cloud is used.")
+    parser.add_argument("--mode", choices=["threads", "asyncio"],
+                        default="threads",
+                        help="Run the workers as threads or as asyncio "
+                             "coroutines (requires aiohttp). "
+                             "(default: threads)")
+    parser.add_argument("--concurrency", type=int, default=50, metavar="N",
+                        help="Number of workers, each with its own "
+                             "connection. (default: 50)")
+    parser.add_argument("--delay-start", type=float, default=4.95,
+                        help="First idle delay, in seconds. (default: 4.95)")
+    parser.add_argument("--delay-stop", type=float, default=4.96,
+                        help="Idle delays stop before this value, in "
+                             "seconds. (default: 4.96)")
+    parser.add_argument("--delay-step", type=float, default=0.005,
+                        help="Increment between two idle delays, in "
+                             "seconds. (default: 0.005)")
+    parser.add_argument("--requests-per-delay", type=int, default=10,
+                        metavar="N",
+                        help="Requests sent by each worker, on the same "
+                             "connection, for each delay. (default: 10)")
+    parser.add_argument("--rate", type=float, metavar="REQ_PER_SEC",
+                        help="Maximum number of requests per second, for all "
+                             "the workers. (default: unlimited)")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Timeout of each request, in seconds. "
+                             "(default: 30)")
+    parser.add_argument("--os-cloud", metavar="NAME",
+                        help="Get a token with 'openstack --os-cloud NAME "
+                             "token issue' and send it in X-Auth-Token.")
+    parser.add_argument("--insecure", action="store_true",
+                        help="Do not verify the server TLS certificate.")
+    parser.add_argument("--stop-on-failure", action="store_true",
+                        help="Stop all the workers at the first failure, "
+                             "like the original reproducer did.")
+    return parser.parse_args()
+
+
+def run_threads(args, url, headers, delays, limiter):
+    results = []
+    exit = threading.Event()
+
+    def get():
+        for delay in delays:
+            session = requests.Session()
+            last_response = None
+
+            for i in range(args.requests_per_delay):
+                if exit.is_set():
+                    return
+
+                # The connection is already idle while waiting for a slot.
+                if exit.wait(limiter.reserve()):
+                    return
+                if i and exit.wait(
+                        max(delay - (time.monotonic() - last_response), 0)):
+                    return
+
+                start = time.monotonic()
+                idle = start - last_response if i else 0.0
+                try:
+                    session.get(url, verify=not args.insecure,
+                                timeout=args.timeout,
+                                headers=dict(headers, **{
+                                    'User-Agent': 'timeout-race/%s' % i}))
+                except Exception as e:
+                    error = repr(e)
+                else:
+                    error = None
+                last_response = time.monotonic()
+
+                results.append(Result(delay, i > 0, idle, error is None,
+                                      last_response - start, error))
+                if error is not None and args.stop_on_failure:
+                    exit.set()
+            session.close()
+
+    threads = [threading.Thread(target=get, daemon=True)
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        exit.set()
+        print("Interrupted, reporting partial results")
+
+    return results
+
+
+def run_asyncio(args, url, headers, delays, limiter):
+    import asyncio
+
+    import aiohttp
+
+    results = []
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    exit = asyncio.Event()
+
+    # aiohttp silently sends an idempotent request again on a new connection
+    # when the server closed the reused one, which hides the race. Spot it: a
+    # connection is created for a request that started on a reused one.
+    async def on_connection_reuseconn(session, context, params):
+        context.trace_request_ctx['reused'] = True
+
+    async def on_connection_create_start(session, context, params):
+        if context.trace_request_ctx.get('reused'):
+            context.trace_request_ctx['retried'] = True
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_connection_create_start.append(
+        on_connection_create_start)
+
+    async def wait(delay):
+        """Sleep, and tell whether all the workers must stop."""
+        try:
+            await asyncio.wait_for(exit.wait(), delay)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def get():
+        for delay in delays:
+            # One connection per worker, kept alive longer than any delay.
+            connector = aiohttp.TCPConnector(
+                limit=1, ssl=False if args.insecure else None,
+                keepalive_timeout=max(delays) + args.timeout)
+            timeout = aiohttp.ClientTimeout(total=args.timeout)
+            async with aiohttp.ClientSession(
+                    connector=connector, timeout=timeout,
+                    trace_configs=[trace_config]) as session:
+                last_response = None
+                for i in range(args.requests_per_delay):
+                    if exit.is_set():
+                        return
+
+                    # The connection is already idle while waiting for a
+                    # slot.
+                    if await wait(limiter.reserve()):
+                        return
+                    if i and await wait(max(
+                            delay - (time.monotonic() - last_response), 0)):
+                        return
+
+                    start = time.monotonic()
+                    idle = start - last_response if i else 0.0
+                    trace = {}
+                    try:
+                        async with session.get(
+                                url, trace_request_ctx=trace,
+                                headers=dict(headers, **{
+                                    'User-Agent': 'timeout-race/%s' % i})
+                        ) as r:
+                            await r.read()
+                    except Exception as e:
+                        error = repr(e)
+                    else:
+                        error = None
+                        if trace.get('retried'):
+                            error = ('Connection closed by the server, '
+                                     'request retried by aiohttp')
+
+                    last_response = time.monotonic()
+
+                    results.append(Result(delay, i > 0, idle, error is None,
+                                          last_response - start, error))
+                    if error is not None and args.stop_on_failure:
+                        exit.set()
+
+    task = asyncio.gather(*[get() for _ in range(args.concurrency)])
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        exit.set()
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        print("Interrupted, reporting partial results")
+    finally:
+        loop.close()
+
+    return results
+
+
+def print_report(results, delays, step):
+    # Requests are counted under the delay closest to how long their
+    # connection actually stayed idle, which is longer than the delay they
+    # waited for when `--rate` or the scheduler kept them waiting.
+    by_delay = collections.defaultdict(list)
+    overdue = 0
+    for result in results:
+        if not result.reused:
+            continue
+        index = int(round((result.idle - delays[0]) / step))
+        if 0 <= index < len(delays):
+            by_delay[delays[index]].append(result)
+        else:
+            overdue += 1
+
+    header = "{:>9} {:>9} {:>9} {:>9} {:>8} {:>9} {:>9} {:>9}".format(
+        "delay (s)", "idle (s)", "requests", "failures", "failed",
+        "p50 (ms)", "p95 (ms)", "p99 (ms)")
+    print(header)
+    print("-" * len(header))
+    for delay, delay_results in sorted(by_delay.items()):
+        failures = sum(1 for r in delay_results if not r.ok)
+        latencies = sorted(r.latency * 1000 for r in delay_results if r.ok)
+        idles = sorted(r.idle for r in delay_results)
+        print("{:>9.3f} {:>9.3f} {:>9} {:>9} {:>7.1f}% {:>9.1f} {:>9.1f} "
+              "{:>9.1f}".format(delay, percentile(idles, 50),
+                                len(delay_results), failures,
+                                100.0 * failures / len(delay_results),
+                                percentile(latencies, 50),
+                                percentile(latencies, 95),
+                                percentile(latencies, 99)))
+
+    if overdue:
+        print("%d request(s) not counted: their connection stayed idle for "
+              "longer than the last delay, e.g because of --rate" % overdue)
+
+    first_failures = sum(1 for r in results if not r.reused and not r.ok)
+    if first_failures:
+        print("%d request(s) failed on a new connection" % first_failures)
+
+    errors = collections.Counter(r.error for r in results if not r.ok)
+    for error, count in errors.most_common(5):
+        print("%6d x %s" % (count, error))
 
-        if exit.is_set():
-            return
 
-        for i in range(10):
+def main():
+    args = parse_args()
 
-            if exit.is_set():
-                return
+    url = args.url
+    headers = {}
+    if args.os_cloud:
+        creds = get_token(args.os_cloud)
+        url = url.format(project_id=creds['project_id'])
+        headers['X-Auth-Token'] = creds['id']
 
-            time.sleep(delay)
-            headers = {
-                'User-Agent': 'timeout-race/%s' % i,
-                'X-Auth-Token': CREDS['id']
-            }
-            try:
-                session.get(URL, verify=False, headers=headers)
-            except Exception as e:
-                print(e)
-                exit.set()
+    if args.insecure:
+        requests.packages.urllib3.disable_warnings()
 
+    delays = list(decimal_range(args.delay_start, args.delay_stop,
+                                args.delay_step))
+    limiter = RateLimiter(args.rate)
 
-threads = []
-exit = threading.Event()
-for i in range(50):
-    threads.append(threading.Thread(target=get,args=(exit,)))
+    run = run_asyncio if args.mode == "asyncio" else run_threads
+    print_report(run(args, url, headers, delays, limiter), delays,
+                 args.delay_step)
 
-for thread in threads:
-    thread.start()
 
-for thread in threads:
-    thread.join()
+if __name__ == "__main__":
+    main()
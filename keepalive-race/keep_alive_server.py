@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+"""
+A local HTTP/1.1 server that closes idle keep-alive connections after a
+timeout, like Apache's `KeepAliveTimeout` in front of the Nova API does.
+
+It is enough to reproduce the keep-alive race without a live Nova: start it
+and send requests that reuse a pooled connection after having waited for
+about `--idle-timeout` seconds, some of them fail with "Connection aborted"
+because the server closed the connection while the request was on its way.
+
+On the loopback interface the client sees the server closing the connection
+almost instantly, so the race window is tiny. `--close-delay` widens it, like
+the latency of a real network (or of a load balancer) would.
+
+    $ ./keep_alive_server.py --port 8774 --idle-timeout 5 --close-delay 0.05
+"""
+import argparse
+import http.server
+import json
+import socketserver
+import time
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Overridden by `main()`. This is the timeout of the socket while waiting
+    # for the next request on a connection, i.e the keep-alive timeout.
+    timeout = 5
+    close_delay = 0
+
+    def handle(self):
+        super().handle()
+        # The connection is being closed: requests that arrive now are not
+        # answered and get their connection reset.
+        time.sleep(self.close_delay)
+
+    def do_GET(self):
+        body = json.dumps({'servers': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve HTTP/1.1 requests and close idle keep-alive "
+                    "connections after a timeout.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on. (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8774,
+                        help="Port to listen on. (default: 8774)")
+    parser.add_argument("--idle-timeout", type=float, default=5.0,
+                        help="Seconds after which an idle connection is "
+                             "closed by the server. (default: 5)")
+    parser.add_argument("--close-delay", type=float, default=0.0,
+                        help="Seconds between the moment the server stops "
+                             "reading from an idle connection and the moment "
+                             "it closes it. (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    KeepAliveHandler.timeout = args.idle_timeout
+    KeepAliveHandler.close_delay = args.close_delay
+    server = ThreadingHTTPServer((args.host, args.port), KeepAliveHandler)
+    print("Listening on http://%s:%d/ with a %.3fs keep-alive timeout" % (
+        args.host, args.port, args.idle_timeout))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+import collections
+import functools
+import threading
+import time
+from typing import Any
+from typing import Optional
+
+from keystoneauth1 import session as ks_session
+import requests
+from requests.packages.urllib3 import connectionpool
+from requests.packages.urllib3 import exceptions as urllib3_exc
+from requests.packages.urllib3.util import retry
+
+# Connections idle for longer than the server idle timeout minus this margin
+# (in seconds) are not reused: the server may be closing them right now.
+IDLE_MARGIN = 1.0
+
+ConnectionStats = collections.namedtuple(
+    'ConnectionStats', ['connections', 'requests', 'discarded']
+)
+
+
+class StaleConnectionRetry(retry.Retry):
+    """
+    Retry policy that only retries idempotent requests whose connection was
+    closed by the server before it answered. This is what happens when the
+    server closes an idle keep-alive connection at the very moment we reuse
+    it. Read timeouts and other errors are not retried.
+
+    vmcleaner/vm_cleaner.py, a standalone script, has a copy of this policy
+    and of the idle timeout pools: keep them in sync.
+    """
+    def __init__(self, total: int = 1, **kwargs: Any) -> None:
+        kwargs.setdefault('connect', 0)
+        kwargs.setdefault('read', total)
+        kwargs.setdefault('status', 0)
+        kwargs.setdefault('other', 0)
+        super().__init__(total=total, **kwargs)
+
+    def _is_read_error(self, err: Exception) -> bool:
+        return isinstance(err, urllib3_exc.ProtocolError)
+
+    def increment(self, method: Optional[str] = None,
+                  url: Optional[str] = None, response: Any = None,
+                  error: Optional[Exception] = None, *args: Any,
+                  **kwargs: Any) -> retry.Retry:
+        # Raised as is, `requests` turns it into a `ReadTimeout` rather than
+        # into a `ConnectionError` wrapping a `MaxRetryError`.
+        if isinstance(error, urllib3_exc.ReadTimeoutError):
+            raise error
+        return super().increment(method, url, response, error, *args,
+                                 **kwargs)
+
+
+class IdleTimeoutPoolMixin(object):
+    """
+    Connection pool that records when each connection was put back in the
+    pool, and discards the ones that have been idle for too long instead of
+    reusing them.
+    """
+    def __init__(self, *args: Any, idle_timeout: Optional[float] = None,
+                 **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)  # type: ignore
+        self.idle_timeout = idle_timeout
+        self.num_discarded = 0
+
+    def _get_conn(self, timeout: Optional[float] = None) -> Any:
+        conn = super()._get_conn(timeout)  # type: ignore
+        idle_since = getattr(conn, 'idle_since', None)
+        if (self.idle_timeout is None or idle_since is None
+                or time.monotonic() - idle_since < self.idle_timeout):
+            return conn
+
+        conn.close()
+        self.num_discarded += 1
+        return self._new_conn()  # type: ignore
+
+    def _put_conn(self, conn: Any) -> None:
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        super()._put_conn(conn)  # type: ignore
+
+
+class IdleTimeoutHTTPConnectionPool(IdleTimeoutPoolMixin,
+                                    connectionpool.HTTPConnectionPool):
+    pass
+
+
+class IdleTimeoutHTTPSConnectionPool(IdleTimeoutPoolMixin,
+                                     connectionpool.HTTPSConnectionPool):
+    pass
+
+
+class PoolingAdapter(ks_session.TCPKeepAliveAdapter):
+    """
+    Transport adapter whose connection pools are sized for our worker threads
+    and which counts how many connections were opened to serve how many
+    requests.
+
+    It inherits from the adapter Keystoneauth mounts by default, so that we
+    keep its TCP Keep-Alive socket options. With the `requests` defaults (10
+    connections per endpoint), extra threads hitting the same endpoint open
+    connections that are then discarded instead of being put back in the pool.
+
+    If `server_idle_timeout` is given, connections that are about to be closed
+    by the server because they have been idle for too long are not reused,
+    and idempotent requests sent on a connection the server closed anyway
+    are retried up to `stale_retries` times.
+    """
+    def __init__(self, *args: Any,
+                 server_idle_timeout: Optional[float] = None,
+                 stale_retries: int = 1, **kwargs: Any) -> None:
+        self._lock = threading.Lock()
+        # Counters of the pools that were already evicted and closed.
+        self._disposed_stats = ConnectionStats(0, 0, 0)
+        self.idle_timeout = None  # type: Optional[float]
+        if server_idle_timeout is not None:
+            self.idle_timeout = max(server_idle_timeout - IDLE_MARGIN, 0)
+            kwargs.setdefault(
+                'max_retries', StaleConnectionRetry(stale_retries))
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(IdleTimeoutHTTPConnectionPool,
+                                      idle_timeout=self.idle_timeout),
+            'https': functools.partial(IdleTimeoutHTTPSConnectionPool,
+                                       idle_timeout=self.idle_timeout),
+        }
+
+        pools = self.poolmanager.pools
+        # Recent urllib3 releases no longer close the evicted pools.
+        dispose_func = pools.dispose_func or (lambda pool: None)
+
+        def dispose_and_count(pool: Any) -> None:
+            with self._lock:
+                self._disposed_stats = ConnectionStats(
+                    *map(sum, zip(self._disposed_stats, _pool_stats(pool)))
+                )
+            dispose_func(pool)
+
+        pools.dispose_func = dispose_and_count
+
+    def get_stats(self) -> ConnectionStats:
+        """
+        Return the number of connections opened, of requests made and of
+        connections discarded because they had been idle for too long.
+        """
+        with self._lock:
+            stats = [self._disposed_stats]
+
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats.append(_pool_stats(pool))
+
+        return ConnectionStats(*map(sum, zip(*stats)))
+
+
+def _pool_stats(pool: connectionpool.HTTPConnectionPool) -> ConnectionStats:
+    return ConnectionStats(
+        pool.num_connections, pool.num_requests,
+        getattr(pool, 'num_discarded', 0)
+    )
+
+
+def mount_pooling_adapter(
+        session: requests.Session, pool_maxsize: int, pool_connections: int,
+        server_idle_timeout: Optional[float] = None
+) -> PoolingAdapter:
+    """
+    Replace the HTTP(S) transport adapters of a `requests` session with a
+    `PoolingAdapter` keeping up to `pool_maxsize` connections per endpoint,
+    for up to `pool_connections` endpoints.
+    """
+    adapter = PoolingAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+        server_idle_timeout=server_idle_timeout
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
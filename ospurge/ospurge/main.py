@@ -11,7 +11,9 @@
 #  License for the specific language governing permissions and limitations
 #  under the License.
 import argparse
+import collections
 import concurrent.futures
+import copy
 import logging
 import operator
 import sys
@@ -21,11 +23,15 @@ import typing
 import os_client_config
 import shade
 
+from ospurge import adapters
 from ospurge import exceptions
 from ospurge.resources.base import ServiceResource
 from ospurge import utils
 
 if typing.TYPE_CHECKING:  # pragma: no cover
+    from typing import Counter  # noqa: F401
+    from typing import Dict  # noqa: F401
+    from typing import List  # noqa: F401
     from typing import Optional  # noqa: F401
 
 
@@ -62,6 +68,23 @@ def create_argument_parser() -> argparse.ArgumentParser:
              "temporarily granted on the project to purge to the "
              "authenticated user."
     )
+    parser.add_argument(
+        "--pool-size", type=int, metavar="N",
+        help="Maximum number of HTTP connections to keep open per API "
+             "endpoint. Defaults to the number of worker threads."
+    )
+    parser.add_argument(
+        "--server-idle-timeout", type=float, default=5.0, metavar="SECONDS",
+        help="Keep-alive timeout of the API servers. Pooled HTTP connections "
+             "are not reused when they are about to reach it, and idempotent "
+             "requests sent on a connection the server closed are retried. "
+             "Defaults to 5 seconds."
+    )
+    parser.add_argument(
+        "--all-regions", action="store_true",
+        help="Purge the project in all the regions found in the service "
+             "catalog, in parallel, instead of only the configured region."
+    )
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
@@ -86,6 +109,7 @@ class CredentialsManager(object):
 
         self.cloud = None  # type: Optional[shade.OpenStackCloud]
         self.operator_cloud = None  # type: Optional[shade.OperatorCloud]
+        self.region_name = None  # type: Optional[str]
 
         if options.purge_own_project:
             self.cloud = shade.openstack_cloud(argparse=options)
@@ -115,6 +139,7 @@ class CredentialsManager(object):
                 )
             )
 
+        self.region_name = self.cloud.cloud_config.region
         auth_args = self.cloud.cloud_config.get_auth_args()
         logging.warning(
             "Going to list and/or delete resources from project '%s'",
@@ -122,6 +147,25 @@ class CredentialsManager(object):
             or auth_args.get('project_id')
         )
 
+    def list_regions(self) -> 'List[str]':
+        return utils.get_regions_from_catalog(self.cloud.service_catalog)
+
+    def for_region(self, region_name: str) -> 'CredentialsManager':
+        """
+        Return a copy of this `CredentialsManager` bound to another region.
+        The new cloud reuses our Keystone session, so that all the regions
+        share the same token instead of each one authenticating again.
+        """
+        region_creds = copy.copy(self)
+        region_creds.region_name = region_name
+        region_creds.cloud = shade.openstack_cloud(
+            **utils.replace_region_info(
+                self.cloud.cloud_config.config, region_name
+            )
+        )
+        region_creds.cloud._keystone_session = self.cloud.keystone_session
+        return region_creds
+
     def ensure_role_on_project(self) -> None:
         if self.operator_cloud and self.operator_cloud.grant_role(
                 self.options.admin_role_name,
@@ -158,7 +202,12 @@ class CredentialsManager(object):
 def runner(
         resource_mngr: ServiceResource, options: argparse.Namespace,
         exit: threading.Event
-) -> None:
+) -> int:
+    """
+    Delete (or just list, in dry-run mode) the resources handled by
+    `resource_mngr`. Return the number of resources that matched.
+    """
+    count = 0
     try:
 
         if not options.dry_run:
@@ -167,11 +216,12 @@ def runner(
         for resource in resource_mngr.list():
             # No need to continue if requested to exit.
             if exit.is_set():
-                return
+                return count
 
             if resource_mngr.should_delete(resource):
                 logging.info("Going to delete %s",
                              resource_mngr.to_str(resource))
+                count += 1
 
                 if options.dry_run:
                     continue
@@ -192,6 +242,28 @@ def runner(
         if not recoverable:
             exit.set()
 
+    return count
+
+
+def region_runner(
+        resource_mngr: ServiceResource, options: argparse.Namespace,
+        exit: threading.Event, stats: 'Dict[Optional[str], Counter[str]]',
+        managers_per_region: int
+) -> None:
+    """
+    Run `runner` for `resource_mngr`, record the number of resources that
+    matched in the stats of its region and log the progress of that region.
+    """
+    region_stats = stats[resource_mngr.region_name]
+    region_stats[resource_mngr.__class__.__name__] = runner(
+        resource_mngr, options=options, exit=exit
+    )
+    logging.info(
+        "Region '%s': done with %s (%d/%d)",
+        resource_mngr.region_name, resource_mngr.__class__.__name__,
+        len(region_stats), managers_per_region
+    )
+
 
 def main() -> None:
     parser = create_argument_parser()
@@ -206,8 +278,20 @@ def main() -> None:
     creds_manager.ensure_enabled_project()
     creds_manager.ensure_role_on_project()
 
+    regions_creds = [creds_manager]
+    if options.all_regions:
+        # Fall back to the configured region if the catalog has no region.
+        regions_creds = [
+            creds_manager.for_region(region_name)
+            for region_name in creds_manager.list_regions()
+        ] or regions_creds
+
+    # Resources of all regions are interleaved and sorted by their order, so
+    # that the lower-ordered resources of every region get a thread first and
+    # none of them waits behind the whole resource graph of another region.
     resource_managers = sorted(
-        [cls(creds_manager) for cls in utils.get_all_resource_classes()],
+        [cls(region_creds) for region_creds in regions_creds
+         for cls in utils.get_all_resource_classes()],
         key=operator.methodcaller('order')
     )
 
@@ -216,18 +300,49 @@ def main() -> None:
     # otherwise there's a chance the cleanup process never finishes.
     exit = threading.Event()
 
+    max_workers = 8 * len(regions_creds)
+
+    # All the regions share the same Keystone session, hence the same HTTP
+    # connection pools. Size them so that every worker thread can keep its
+    # own connection to an endpoint instead of opening a new one each time.
+    http_adapter = adapters.mount_pooling_adapter(
+        creds_manager.cloud.keystone_session.session,
+        pool_maxsize=options.pool_size or max_workers,
+        pool_connections=10 * len(regions_creds),
+        server_idle_timeout=options.server_idle_timeout
+    )
+
+    # Number of resources that matched, per region and per resource type.
+    # Filled before starting the threads so that they never add keys.
+    stats = {
+        region_creds.region_name: collections.Counter()
+        for region_creds in regions_creds
+    }  # type: Dict[Optional[str], Counter[str]]
+    managers_per_region = len(resource_managers) // len(regions_creds)
+
     # Dummy function to work around `ThreadPoolExecutor.map()` not accepting
     # a callable with arguments.
     def partial_runner(resource_manager: ServiceResource) -> None:
-        runner(resource_manager, options=options,
-               exit=exit)  # pragma: no cover
+        region_runner(
+            resource_manager, options=options, exit=exit, stats=stats,
+            managers_per_region=managers_per_region
+        )  # pragma: no cover
 
     try:
-        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
             executor.map(partial_runner, resource_managers)
     except KeyboardInterrupt:
         exit.set()
 
+    for region_name, region_stats in sorted(stats.items(), key=str):
+        logging.warning(
+            "Region '%s': %d resources %s", region_name,
+            sum(region_stats.values()),
+            "found" if options.dry_run else "deleted"
+        )
+    logging.info("%d HTTP connection(s) opened for %d request(s), %d "
+                 "discarded because idle", *http_adapter.get_stats())
+
     if creds_manager.revoke_role_after_purge:
         creds_manager.revoke_role_on_project()
 
@@ -84,6 +84,7 @@ class BaseServiceResource(object):
         self.cloud = None  # type: Optional[shade.OpenStackCloud]
         self.cleanup_project_id = None  # type: Optional[str]
         self.options = None  # type: Optional[argparse.Namespace]
+        self.region_name = None  # type: Optional[str]
 
 
 class ServiceResource(BaseServiceResource, metaclass=CodingStyleMixin):
@@ -99,6 +100,7 @@ class ServiceResource(BaseServiceResource, metaclass=CodingStyleMixin):
         self.cloud = creds_manager.cloud
         self.options = creds_manager.options
         self.cleanup_project_id = creds_manager.project_id
+        self.region_name = creds_manager.region_name
 
     @classmethod
     def order(cls) -> int:
@@ -0,0 +1,266 @@
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+import http.server
+import socketserver
+import threading
+import time
+import unittest
+from unittest import mock
+
+from keystoneauth1 import session as ks_session
+import requests
+from requests.packages.urllib3 import exceptions as urllib3_exc
+
+from ospurge import adapters
+
+
+class DropReusedConnectionHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer the first request of each connection, and close the connection
+    without answering the next one. This is what a server does when its
+    keep-alive timeout expires at the very moment the client reuses the
+    connection, minus the timing.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self) -> None:
+        self.handle_one_request()
+        if not self.close_connection:
+            self.rfile.readline()
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    do_POST = do_GET
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """Answer each request after a second."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        time.sleep(1)
+        DropReusedConnectionHandler.do_GET(self)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+
+
+class TestStaleConnectionRetry(unittest.TestCase):
+    def test_init(self):
+        policy = adapters.StaleConnectionRetry(2)
+        self.assertEqual(2, policy.total)
+        self.assertEqual(2, policy.read)
+        self.assertEqual(0, policy.connect)
+        self.assertEqual(0, policy.status)
+
+    def test_is_read_error(self):
+        policy = adapters.StaleConnectionRetry()
+        self.assertTrue(policy._is_read_error(
+            urllib3_exc.ProtocolError('Connection aborted.')))
+        self.assertFalse(policy._is_read_error(
+            urllib3_exc.ReadTimeoutError(None, None, 'Read timed out.')))
+
+    def test_increment_read_timeout(self):
+        policy = adapters.StaleConnectionRetry()
+        error = urllib3_exc.ReadTimeoutError(None, None, 'Read timed out.')
+        with self.assertRaises(urllib3_exc.ReadTimeoutError) as cm:
+            policy.increment('GET', '/', error=error)
+        self.assertIs(error, cm.exception)
+
+    def test_increment_stale_connection(self):
+        policy = adapters.StaleConnectionRetry()
+        policy = policy.increment(
+            'GET', '/', error=urllib3_exc.ProtocolError('Connection aborted.'))
+        self.assertEqual(0, policy.total)
+
+
+class TestIdleTimeoutPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = adapters.IdleTimeoutHTTPConnectionPool(
+            'example.org', idle_timeout=4.0)
+
+    @mock.patch('time.monotonic', autospec=True)
+    def test_put_conn(self, m_monotonic):
+        conn = self.pool._get_conn()
+        self.pool._put_conn(conn)
+
+        self.assertEqual(m_monotonic.return_value, conn.idle_since)
+        self.pool._put_conn(None)
+
+    @mock.patch('time.monotonic', autospec=True)
+    def test_get_conn_reuse(self, m_monotonic):
+        conn = self.pool._get_conn()
+        m_monotonic.return_value = 10
+        self.pool._put_conn(conn)
+
+        m_monotonic.return_value = 13.9
+        self.assertIs(conn, self.pool._get_conn())
+        self.assertEqual(0, self.pool.num_discarded)
+
+    @mock.patch('time.monotonic', autospec=True)
+    def test_get_conn_discard_idle(self, m_monotonic):
+        conn = self.pool._get_conn()
+        m_monotonic.return_value = 10
+        self.pool._put_conn(conn)
+
+        m_monotonic.return_value = 14
+        with mock.patch.object(conn, 'close') as m_close:
+            new_conn = self.pool._get_conn()
+
+        self.assertTrue(m_close.called)
+        self.assertIsNot(conn, new_conn)
+        self.assertEqual(1, self.pool.num_discarded)
+        self.assertEqual(2, self.pool.num_connections)
+
+    def test_get_conn_without_idle_timeout(self):
+        pool = adapters.IdleTimeoutHTTPSConnectionPool('example.org')
+        conn = pool._get_conn()
+        pool._put_conn(conn)
+
+        self.assertIs(conn, pool._get_conn())
+
+
+class TestPoolingAdapter(unittest.TestCase):
+    def test_init(self):
+        adapter = adapters.PoolingAdapter(pool_connections=3, pool_maxsize=7)
+
+        self.assertIsInstance(adapter, ks_session.TCPKeepAliveAdapter)
+        self.assertEqual(3, adapter.poolmanager.pools._maxsize)
+        self.assertEqual(7, adapter.poolmanager.connection_pool_kw['maxsize'])
+        self.assertIsNone(adapter.idle_timeout)
+        self.assertNotIsInstance(adapter.max_retries,
+                                 adapters.StaleConnectionRetry)
+        self.assertEqual((0, 0, 0), adapter.get_stats())
+
+    def test_init_with_server_idle_timeout(self):
+        adapter = adapters.PoolingAdapter(server_idle_timeout=5,
+                                          stale_retries=2)
+
+        self.assertEqual(4.0, adapter.idle_timeout)
+        self.assertIsInstance(adapter.max_retries,
+                              adapters.StaleConnectionRetry)
+        self.assertEqual(2, adapter.max_retries.total)
+
+        pool = adapter.poolmanager.connection_from_host('example.org', 443,
+                                                        'https')
+        self.assertIsInstance(pool, adapters.IdleTimeoutHTTPSConnectionPool)
+        self.assertEqual(4.0, pool.idle_timeout)
+
+        adapter = adapters.PoolingAdapter(server_idle_timeout=0.5)
+        self.assertEqual(0, adapter.idle_timeout)
+
+    def test_get_stats(self):
+        adapter = adapters.PoolingAdapter(pool_connections=1)
+        pool = adapter.poolmanager.connection_from_host('example.org', 443,
+                                                        'https')
+        pool.num_connections, pool.num_requests = 2, 5
+        pool.num_discarded = 1
+
+        self.assertEqual((2, 5, 1), adapter.get_stats())
+
+    def test_get_stats_with_evicted_pool(self):
+        adapter = adapters.PoolingAdapter(pool_connections=1)
+        pool = adapter.poolmanager.connection_from_host('example.org', 443,
+                                                        'https')
+        pool.num_connections, pool.num_requests = 2, 5
+        # Only one pool is kept, so the first one gets evicted and closed.
+        pool2 = adapter.poolmanager.connection_from_host('example.com', 443,
+                                                         'https')
+        pool2.num_connections, pool2.num_requests = 1, 1
+
+        self.assertEqual(1, len(adapter.poolmanager.pools))
+        self.assertEqual((3, 6, 0), adapter.get_stats())
+
+    def test_mount_pooling_adapter(self):
+        session = mock.Mock(spec=requests.Session)
+        adapter = adapters.mount_pooling_adapter(
+            session, pool_maxsize=16, pool_connections=20,
+            server_idle_timeout=60)
+
+        self.assertIsInstance(adapter, adapters.PoolingAdapter)
+        self.assertEqual(
+            [mock.call('https://', adapter), mock.call('http://', adapter)],
+            session.mount.call_args_list
+        )
+        self.assertEqual(20, adapter.poolmanager.pools._maxsize)
+        self.assertEqual(16,
+                         adapter.poolmanager.connection_pool_kw['maxsize'])
+        self.assertEqual(59, adapter.idle_timeout)
+
+
+class TestPoolingAdapterWithServer(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          DropReusedConnectionHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def test_stale_connection_without_retry(self):
+        with requests.Session() as session:
+            session.get(self.url)
+            self.assertRaises(requests.ConnectionError,
+                              session.get, self.url)
+
+    def test_stale_connection_retried(self):
+        with requests.Session() as session:
+            adapter = adapters.mount_pooling_adapter(
+                session, pool_maxsize=1, pool_connections=1,
+                server_idle_timeout=60)
+
+            for _ in range(3):
+                self.assertEqual({}, session.get(self.url).json())
+
+            # The second and third requests were each sent twice: first on
+            # the stale connection, then on a new one.
+            self.assertEqual(5, adapter.get_stats().requests)
+
+    def test_stale_connection_not_idempotent(self):
+        with requests.Session() as session:
+            adapters.mount_pooling_adapter(
+                session, pool_maxsize=1, pool_connections=1,
+                server_idle_timeout=60)
+
+            session.post(self.url)
+            self.assertRaises(requests.ConnectionError,
+                              session.post, self.url)
+
+
+class TestPoolingAdapterWithSlowServer(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def test_read_timeout(self):
+        with requests.Session() as session:
+            adapters.mount_pooling_adapter(
+                session, pool_maxsize=1, pool_connections=1,
+                server_idle_timeout=60)
+
+            self.assertRaises(requests.ReadTimeout,
+                              session.get, self.url, timeout=0.3)
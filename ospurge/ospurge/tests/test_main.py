@@ -10,6 +10,7 @@
 #  License for the specific language governing permissions and limitations
 #  under the License.
 import argparse
+import collections
 import logging
 import types
 import unittest
@@ -46,6 +47,7 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(True, options.dry_run)
         self.assertEqual(True, options.delete_shared_resources)
         self.assertEqual('foo', options.purge_project)
+        self.assertEqual(False, options.all_regions)
 
     def test_create_argument_parser_with_purge_own_project(self):
         parser = main.create_argument_parser()
@@ -56,14 +58,38 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(False, options.delete_shared_resources)
         self.assertEqual(True, options.purge_own_project)
 
+    def test_create_argument_parser_with_all_regions(self):
+        parser = main.create_argument_parser()
+        options = parser.parse_args(['--purge-own-project', '--all-regions'])
+
+        self.assertEqual(True, options.all_regions)
+
+    def test_create_argument_parser_with_pool_size(self):
+        parser = main.create_argument_parser()
+        options = parser.parse_args(['--purge-own-project'])
+        self.assertIsNone(options.pool_size)
+
+        options = parser.parse_args(['--purge-own-project', '--pool-size=4'])
+        self.assertEqual(4, options.pool_size)
+
+    def test_create_argument_parser_with_server_idle_timeout(self):
+        parser = main.create_argument_parser()
+        options = parser.parse_args(['--purge-own-project'])
+        self.assertEqual(5.0, options.server_idle_timeout)
+
+        options = parser.parse_args(
+            ['--purge-own-project', '--server-idle-timeout=60'])
+        self.assertEqual(60.0, options.server_idle_timeout)
+
     def test_runner(self):
         resources = [mock.Mock(), mock.Mock(), mock.Mock()]
         resource_manager = mock.Mock(list=mock.Mock(return_value=resources))
         options = mock.Mock(dry_run=False)
         exit = mock.Mock(is_set=mock.Mock(side_effect=[False, False, True]))
 
-        main.runner(resource_manager, options, exit)
+        count = main.runner(resource_manager, options, exit)
 
+        self.assertEqual(2, count)
         resource_manager.list.assert_called_once_with()
         resource_manager.wait_for_check_prerequisite.assert_called_once_with(
             exit)
@@ -83,8 +109,9 @@ class TestFunctions(unittest.TestCase):
         options = mock.Mock(dry_run=True)
         exit = mock.Mock(is_set=mock.Mock(return_value=False))
 
-        main.runner(resource_manager, options, exit)
+        count = main.runner(resource_manager, options, exit)
 
+        self.assertEqual(2, count)
         resource_manager.wait_for_check_prerequisite.assert_not_called()
         resource_manager.delete.assert_not_called()
 
@@ -108,6 +135,23 @@ class TestFunctions(unittest.TestCase):
 
         self.assertFalse(exit.set.called)
 
+    @mock.patch.object(main, 'runner', return_value=3)
+    def test_region_runner(self, m_runner):
+        resource_manager = mock.Mock(region_name='RegionOne')
+        options, exit = mock.Mock(), mock.Mock()
+        stats = {'RegionOne': collections.Counter(),
+                 'RegionTwo': collections.Counter()}
+
+        with mock.patch.object(main.logging, 'info') as m_info:
+            main.region_runner(resource_manager, options, exit, stats, 4)
+
+        m_runner.assert_called_once_with(resource_manager, options=options,
+                                         exit=exit)
+        self.assertEqual({'Mock': 3}, stats['RegionOne'])
+        self.assertEqual({}, stats['RegionTwo'])
+        m_info.assert_called_once_with(
+            "Region '%s': done with %s (%d/%d)", 'RegionOne', 'Mock', 1, 4)
+
     @mock.patch.object(main, 'os_client_config', autospec=True)
     @mock.patch.object(main, 'shade')
     @mock.patch('argparse.ArgumentParser.parse_args')
@@ -119,6 +163,9 @@ class TestFunctions(unittest.TestCase):
         m_tpe.return_value.__enter__.return_value.map.side_effect = \
             KeyboardInterrupt
         m_parse_args.return_value.purge_own_project = False
+        m_parse_args.return_value.all_regions = False
+        m_parse_args.return_value.pool_size = None
+        m_parse_args.return_value.server_idle_timeout = None
         m_shade.operator_cloud().get_project().enabled = False
 
         main.main()
@@ -142,6 +189,63 @@ class TestFunctions(unittest.TestCase):
         m_event.return_value.is_set.assert_called_once_with()
         self.assertIsInstance(m_sys_exit.call_args[0][0], int)
 
+    @mock.patch.object(main, 'os_client_config', autospec=True)
+    @mock.patch.object(main, 'shade')
+    @mock.patch('argparse.ArgumentParser.parse_args')
+    @mock.patch('concurrent.futures.ThreadPoolExecutor', autospec=True)
+    @mock.patch('sys.exit', autospec=True)
+    def test_main_with_all_regions(self, m_sys_exit, m_tpe, m_parse_args,
+                                   m_shade, m_oscc):
+        m_parse_args.return_value.purge_own_project = True
+        m_parse_args.return_value.all_regions = True
+        m_parse_args.return_value.pool_size = None
+        m_shade.openstack_cloud.return_value.service_catalog = [
+            {'endpoints': [{'region': 'RegionOne'}, {'region': 'RegionTwo'}]}
+        ]
+
+        with mock.patch.object(
+                main.adapters, 'mount_pooling_adapter') as m_mount:
+            m_mount.return_value.get_stats.return_value = (1, 2, 0)
+            main.main()
+
+        m_mount.assert_called_once_with(
+            m_shade.openstack_cloud.return_value.keystone_session.session,
+            pool_maxsize=16, pool_connections=20,
+            server_idle_timeout=m_parse_args.return_value.server_idle_timeout
+        )
+
+        executor = m_tpe.return_value.__enter__.return_value
+        resource_managers = list(executor.map.call_args[0][1])
+        self.assertEqual(
+            {'RegionOne', 'RegionTwo'},
+            {rm.region_name for rm in resource_managers}
+        )
+        self.assertEqual(
+            sorted(rm.order() for rm in resource_managers),
+            [rm.order() for rm in resource_managers]
+        )
+        self.assertEqual(16, m_tpe.call_args[0][0])
+
+    @mock.patch.object(main, 'os_client_config', autospec=True)
+    @mock.patch.object(main, 'shade')
+    @mock.patch('argparse.ArgumentParser.parse_args')
+    @mock.patch('concurrent.futures.ThreadPoolExecutor', autospec=True)
+    @mock.patch('sys.exit', autospec=True)
+    def test_main_with_all_regions_no_region(self, m_sys_exit, m_tpe,
+                                             m_parse_args, m_shade, m_oscc):
+        m_parse_args.return_value.purge_own_project = True
+        m_parse_args.return_value.all_regions = True
+        m_parse_args.return_value.pool_size = 3
+        m_shade.openstack_cloud.return_value.service_catalog = []
+
+        with mock.patch.object(
+                main.adapters, 'mount_pooling_adapter') as m_mount:
+            m_mount.return_value.get_stats.return_value = (1, 2, 0)
+            main.main()
+
+        self.assertEqual(8, m_tpe.call_args[0][0])
+        self.assertEqual(3, m_mount.call_args[1]['pool_maxsize'])
+
 
 @mock.patch.object(main, 'shade')
 class TestCredentialsManager(unittest.TestCase):
@@ -202,6 +306,32 @@ class TestCredentialsManager(unittest.TestCase):
         )
         creds_mgr.cloud.cloud_config.get_auth_args.assert_called_once_with()
 
+    def test_list_regions(self, m_shade):
+        creds_mgr = main.CredentialsManager(mock.Mock())
+        creds_mgr.cloud.service_catalog = [
+            {'endpoints': [{'region_id': 'R2'}, {'region': 'R1'}]}
+        ]
+
+        self.assertEqual(['R1', 'R2'], creds_mgr.list_regions())
+
+    @mock.patch.object(utils, 'replace_region_info')
+    def test_for_region(self, m_replace, m_shade):
+        creds_mgr = main.CredentialsManager(mock.Mock())
+        cloud = creds_mgr.cloud
+        m_shade.openstack_cloud.reset_mock()
+
+        region_creds = creds_mgr.for_region('RegionTwo')
+
+        self.assertEqual('RegionTwo', region_creds.region_name)
+        self.assertEqual(creds_mgr.project_id, region_creds.project_id)
+        self.assertIs(cloud, creds_mgr.cloud)
+        m_replace.assert_called_once_with(
+            cloud.cloud_config.config, 'RegionTwo')
+        m_shade.openstack_cloud.assert_called_once_with(
+            **m_replace.return_value)
+        self.assertIs(cloud.keystone_session,
+                      region_creds.cloud._keystone_session)
+
     def test_init_with_project_not_found(self, m_shade):
         m_shade.operator_cloud.return_value.get_project.return_value = None
         self.assertRaises(
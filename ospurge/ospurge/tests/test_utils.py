@@ -43,6 +43,29 @@ class TestUtils(unittest.TestCase):
             }
         })
 
+    def test_replace_region_info_in_config(self):
+        config = {'cloud': 'foo', 'region_name': 'RegionOne'}
+        new_conf = utils.replace_region_info(config, 'RegionTwo')
+
+        self.assertEqual(new_conf, {'region_name': 'RegionTwo'})
+        self.assertEqual(config, {'cloud': 'foo', 'region_name': 'RegionOne'})
+
+    def test_get_regions_from_catalog(self):
+        catalog = [
+            {'type': 'compute', 'endpoints': [
+                {'region': 'RegionOne'}, {'region': 'RegionTwo'}
+            ]},
+            {'type': 'identity', 'endpoints': [
+                {'region_id': 'RegionOne', 'region': 'RegionOne'},
+                {'interface': 'public'}
+            ]},
+            {'type': 'empty'}
+        ]
+        self.assertEqual(
+            ['RegionOne', 'RegionTwo'],
+            utils.get_regions_from_catalog(catalog)
+        )
+
     def test_get_all_resource_classes(self):
         classes = utils.get_all_resource_classes()
         self.assertIsInstance(classes, typing.List)
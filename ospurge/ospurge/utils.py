@@ -90,3 +90,30 @@ def replace_project_info(config: Dict, new_project_id: str) -> Dict[str, Any]:
     new_conf['auth']['project_id'] = new_project_id
 
     return new_conf
+
+
+def replace_region_info(config: Dict, new_region_name: str) -> Dict[str, Any]:
+    """
+    Replace the region in a `os_client_config` config dict. This is used to
+    get a cloud bound to another region of the same cloud.
+    """
+    new_conf = copy.deepcopy(config)
+    new_conf.pop('cloud', None)
+    new_conf['region_name'] = new_region_name
+
+    return new_conf
+
+
+def get_regions_from_catalog(catalog: List[Dict]) -> List[str]:
+    """
+    Return the sorted names of all the regions that have at least one
+    endpoint in a Keystone service catalog (either v2 or v3 format).
+    """
+    regions = set()
+    for service in catalog:
+        for endpoint in service.get('endpoints', []):
+            region = endpoint.get('region_id') or endpoint.get('region')
+            if region:
+                regions.add(region)
+
+    return sorted(regions)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Compare the line by line parser of tempest_timing with the byte-level
+scanner, on a synthetic console log.
+
+The log looks like a devstack job console: mostly unrelated output, with one
+test result line every `--noise` lines. Both parsers must find the same tests.
+
+    $ ./bench_scanner.py --size 300
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import tempest_timing
+
+NOISE = [
+    '2016-05-26 12:34:56.789 | + /opt/stack/new/devstack/functions-common:'
+    'is_service_enabled:1987 :   return 0',
+    '2016-05-26 12:34:56.789 | 2016-05-26 12:34:56.123 12345 DEBUG '
+    'oslo_concurrency.lockutils [-] Lock "compute_resources" released by '
+    '"update_available_resource" :: held 0.042s',
+    '2016-05-26 12:34:56.789 | Collecting python-novaclient>=2.29.0 (from '
+    'tempest==11.0.1.dev75)',
+    '2016-05-26 12:34:56.789 | ok: [localhost] => (item=tempest.conf)',
+]
+
+
+def write_log(path, size, noise):
+    """
+    Write a synthetic console log of about `size` bytes
+
+    :type path: str
+    :type size: int
+    :param noise: number of unrelated lines per test result line
+    :type noise: int
+    """
+    rng = random.Random(42)
+    written = 0
+    test = 0
+    with open(path, 'w') as log_file:
+        while written < size:
+            lines = [rng.choice(NOISE) for _ in range(noise)]
+            lines.append(
+                '2016-05-26 12:34:56.789 | {%d} tempest.api.compute.servers.'
+                'test_servers.ServersTestJSON.test_%d[id-%08x,smoke] '
+                '[%.6fs] ... ok' % (test % 4, test, test, rng.random() * 10))
+            test += 1
+            block = '\n'.join(lines) + '\n'
+            log_file.write(block)
+            written += len(block)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the console log parsers of tempest_timing.")
+    parser.add_argument("--size", type=int, default=300,
+                        help="Size of the synthetic log, in megabytes "
+                             "(default: 300)")
+    parser.add_argument("--noise", type=int, default=200,
+                        help="Unrelated lines per test line (default: 200)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'console.html')
+        write_log(path, args.size * 1024 * 1024, args.noise)
+
+        start = time.monotonic()
+        by_line = list(tempest_timing.get_test_names_and_durations(
+            tempest_timing.get_log_lines(path)))
+        line_time = time.monotonic() - start
+
+        start = time.monotonic()
+        scanned = tempest_timing.get_test_records(path)
+        scan_time = time.monotonic() - start
+
+    assert by_line == scanned, "The parsers found different tests"
+    print("%d MB, %d tests" % (args.size, len(scanned)))
+    print("line by line: %6.2fs (%.0f MB/s)" % (line_time,
+                                                args.size / line_time))
+    print("byte scanner: %6.2fs (%.0f MB/s)" % (scan_time,
+                                                args.size / scan_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,94 +1,994 @@
 #!/usr/bin/env python
 import argparse
 import collections
+from concurrent import futures
+import datetime
+import glob
+import hashlib
+import json
+import os
 import re
+import statistics
+import sys
+import tempfile
+import threading
+import zlib
 
 import requests
 
+try:
+    import timing_store
+except ImportError:  # NumPy is only required by --store
+    timing_store = None
+
+# Size of the chunks read from the network or from a file, in bytes.
+CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+# (fragment of test name, service) pairs. The first pair whose fragment is in
+# the name of a test gives the service the test primarily tests. This is based
+# partly on the location of the test in Tempest structure, partly on the
+# knowledge of the test itself.
+DEFAULT_RULES = [
+    ('.api.volume.', 'cinder'),
+    ('.api.compute.', 'nova'),
+    ('.api.image.', 'glance'),
+    ('.api.network.', 'neutron'),
+    ('.api.identity.', 'keystone'),
+    ('.api.object_storage.', 'swift'),
+    ('.api.orchestration.', 'heat'),
+    ('.api.baremetal.', 'ironic'),
+    ('.api.data_processing.', 'sahara'),
+    ('.api.database.', 'trove'),
+    ('.api.telemetry.', 'ceilometer'),
+    ('.api.messaging.', 'zaqar'),
+    ('.test_server_advanced_ops.', 'nova'),
+    ('.test_shelve_instance.', 'nova'),
+    ('.test_server_basic_ops.', 'nova'),
+    ('.test_snapshot_pattern.', 'cinder'),
+    ('.test_stamp_pattern.', 'cinder'),
+    ('.test_volume_boot_pattern.', 'cinder'),
+    ('.test_network_basic_ops.', 'neutron'),
+    ('.test_network_advanced_server_ops.', 'neutron'),
+    ('.test_network_v6.', 'neutron'),
+    ('.test_security_groups_basic_ops.', 'neutron'),
+    ('.test_object_storage_basic_ops.', 'swift'),
+]
+DEFAULT_SERVICE = 'other'
+
+# A test that ran on a worker, with the time it ended at (in seconds since the
+# epoch), which is when its result line was printed.
+TestRun = collections.namedtuple(
+    'TestRun', ['name', 'duration', 'worker', 'end']
+)
+
 
 def create_argument_parser():
     """
     :rtype: argparse.ArgumentParser
     """
     parser = argparse.ArgumentParser(
-        description="Profile a Tempest run per OpenStack service."
+        description="Profile Tempest runs per OpenStack service."
+    )
+    parser.add_argument(
+        "console_logs", nargs='*', metavar="console_log",
+        help="URL, path or glob of paths to console.html(.gz) files. With "
+             "several logs, the mean, median and 95th percentile of the time "
+             "spent per service are printed."
+    )
+    parser.add_argument(
+        "--rules", metavar="PATH",
+        help="JSON file with a list of {\"match\": ..., \"service\": ...} "
+             "objects. A test belongs to the service of the first rule whose "
+             "'match' is part of its name. Replaces the built-in rules."
+    )
+    parser.add_argument(
+        "--timeline", action="store_true",
+        help="For a single log, rebuild the timeline of the tests on the "
+             "workers and print the wall-clock time per service, the "
+             "services of the worker that finished last and the utilization "
+             "of each worker"
+    )
+    parser.add_argument(
+        "--store", metavar="PATH",
+        help="Directory of a columnar store where the test durations of the "
+             "analysed runs are added (requires NumPy)"
+    )
+    parser.add_argument(
+        "--trend", action="store_true",
+        help="Instead of analysing logs, print how the time spent per "
+             "service and per test evolved over the runs of --store"
+    )
+    parser.add_argument(
+        "--regressions", action="store_true",
+        help="Instead of adding the runs to --store, print the tests that "
+             "got slower than in the runs of --store, and exit with status 1 "
+             "if any did"
+    )
+    parser.add_argument(
+        "--margin", type=float, default=0.2,
+        help="With --regressions, how much above the 95th percentile of its "
+             "previous durations the median duration of a test must be, as a "
+             "fraction (default: 0.2)"
+    )
+    parser.add_argument(
+        "--min-delta", type=float, default=1.0, metavar="SECONDS",
+        help="With --regressions, ignore slowdowns smaller than this "
+             "(default: 1)"
+    )
+    parser.add_argument(
+        "--min-runs", type=int, default=5,
+        help="With --regressions, ignore the tests that ran in fewer runs of "
+             "the store (default: 5)"
+    )
+    parser.add_argument(
+        "--top", type=int, default=20,
+        help="Number of tests printed by --trend (default: 20)"
     )
     parser.add_argument(
-        "console_log",
-        help="URL to a console.html.gz file"
+        "--cache-dir", metavar="PATH",
+        default=os.path.expanduser("~/.cache/tempest_timing"),
+        help="Directory where downloaded logs and parsed test durations are "
+             "cached (default: ~/.cache/tempest_timing)"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=2048, metavar="MB",
+        help="Size above which the least recently used entries of the cache "
+             "are removed, in megabytes (default: 2048)"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Neither read nor fill the cache"
+    )
+    parser.add_argument(
+        "--download-workers", type=int, default=8,
+        help="Number of logs downloaded concurrently (default: 8)"
+    )
+    parser.add_argument(
+        "--parse-workers", type=int, default=os.cpu_count(),
+        help="Number of processes parsing logs (default: number of CPUs)"
     )
     return parser
 
 
-def get_log_lines(log_url):
+def is_url(location):
+    return location.startswith(('http://', 'https://'))
+
+
+def expand_locations(locations):
     """
-    Get the text content of an URL
+    Replace the globs among local paths by the paths they match
 
-    :param log_url: URL to GET
-    :type log_url: str
+    :type locations: list[str]
     :rtype: list[str]
     """
-    response = requests.get(log_url)
-    return response.content.decode().split('\n')
+    expanded = []
+    for location in locations:
+        if not is_url(location) and glob.has_magic(location):
+            expanded.extend(sorted(glob.glob(location)))
+        else:
+            expanded.append(location)
+    return expanded
+
+
+def iter_chunks(location):
+    """
+    Read an URL or a local file chunk by chunk
+
+    :param location: URL to GET or path of a file
+    :type location: str
+    :rtype: collections.Iterator[bytes]
+    """
+    if is_url(location):
+        with requests.get(location, stream=True) as response:
+            response.raise_for_status()
+            # The body is decoded if it was sent with a Content-Encoding, but
+            # not if the file itself is compressed.
+            for chunk in response.iter_content(CHUNK_SIZE):
+                yield chunk
+    else:
+        with open(location, 'rb') as log_file:
+            for chunk in iter(lambda: log_file.read(CHUNK_SIZE), b''):
+                yield chunk
+
+
+def decompress_chunks(chunks):
+    """
+    Decompress chunks of gzip data as they come, and pass through chunks of
+    data that is not compressed
+
+    :type chunks: collections.Iterable[bytes]
+    :rtype: collections.Iterator[bytes]
+    """
+    chunks = iter(chunks)
+    decompressor = None
+    for chunk in chunks:
+        if decompressor is None:
+            if not chunk:
+                continue
+            if not chunk.startswith(GZIP_MAGIC):
+                yield chunk
+                yield from chunks
+                return
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        yield decompressor.decompress(chunk)
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def iter_lines(chunks):
+    """
+    Split chunks of bytes into lines of text
+
+    :type chunks: collections.Iterable[bytes]
+    :rtype: collections.Iterator[str]
+    """
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode(errors='replace')
+    if pending:
+        yield pending.decode(errors='replace')
+
+
+def get_log_lines(location):
+    """
+    Get the lines of text of an URL or of a file, gzipped or not
+
+    Only one chunk of the file is held in memory at a time.
+
+    :param location: URL to GET or path of a file
+    :type location: str
+    :rtype: collections.Iterator[str]
+    """
+    return iter_lines(decompress_chunks(iter_chunks(location)))
+
+
+NAME_AND_DURATION = r'(tempest\..*) \[(\d+\.\d+)s\]'
 
 
 def get_test_names_and_durations(log_lines):
     """
     Extract test names and test durations from the logs
 
-    :type log_lines: list[str]
+    :type log_lines: collections.Iterable[str]
     :rtype list[(str, float)]
     """
-    name_and_duration = re.compile(r'(tempest\..*) \[(\d+\.\d+)s\]')
+    name_and_duration = re.compile(NAME_AND_DURATION)
     for line in log_lines:
         match = name_and_duration.search(line)
         if match:
             yield match.group(1), float(match.group(2))
 
 
+def scan_test_names_and_durations(chunks):
+    """
+    Same as `get_test_names_and_durations()`, from chunks of raw bytes
+
+    Most of a console log is not about tests, so lines are neither decoded
+    nor split one by one. Instead, `bytes.find()` jumps from one occurrence
+    of "tempest." to the next, and only the lines that also contain "s]"
+    are matched against the regex.
+
+    :type chunks: collections.Iterable[bytes]
+    :rtype: collections.Iterator[(str, float)]
+    """
+    name_and_duration = re.compile(NAME_AND_DURATION.encode())
+    pending = b''
+    for chunk in chunks:
+        buffer = pending + chunk
+        # Only complete lines are scanned, the last one is kept for later.
+        limit = buffer.rfind(b'\n') + 1
+        pending = buffer[limit:]
+        for name, duration in _scan_buffer(buffer, limit, name_and_duration):
+            yield name, duration
+    if pending:
+        for name, duration in _scan_buffer(pending, len(pending),
+                                           name_and_duration):
+            yield name, duration
+
+
+def _scan_buffer(buffer, limit, name_and_duration):
+    position = 0
+    while True:
+        position = buffer.find(b'tempest.', position, limit)
+        if position < 0:
+            return
+        line_end = buffer.find(b'\n', position, limit)
+        if line_end < 0:
+            line_end = limit
+        if buffer.find(b's]', position, line_end) >= 0:
+            line_start = buffer.rfind(b'\n', 0, position) + 1
+            match = name_and_duration.search(buffer, line_start, line_end)
+            if match:
+                yield (match.group(1).decode(errors='replace'),
+                       float(match.group(2)))
+        position = line_end + 1
+
+
+def get_test_runs(log_lines):
+    """
+    Extract the tests of the logs with the worker that ran them and the time
+    they ended at
+
+    Only the lines of the form
+    "2016-05-26 12:34:56.789 | {0} tempest.x.y [1.234s] ... ok" are
+    considered.
+
+    :type log_lines: collections.Iterable[str]
+    :rtype: collections.Iterator[TestRun]
+    """
+    test_run = re.compile(
+        r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d+) \| \{(\d+)\} '
+        r'(tempest\..*) \[(\d+\.\d+)s\]'
+    )
+    for line in log_lines:
+        match = test_run.search(line)
+        if match:
+            end = datetime.datetime.strptime(
+                match.group(1), '%Y-%m-%d %H:%M:%S.%f'
+            ).replace(tzinfo=datetime.timezone.utc).timestamp()
+            yield TestRun(match.group(3), float(match.group(4)),
+                          int(match.group(2)), end)
+
+
+def get_wall_clock_profile(test_runs, classifier):
+    """
+    Tell what lengthens a run whose tests ran on several workers
+
+    Summing the durations of the tests of a service overstates its cost, as
+    tests run in parallel. Instead, the timeline of the run is cut at each
+    start and end of a test, and each slice of time is shared equally
+    between the tests running during it.
+
+    The critical path is the sequence of tests of the worker that finished
+    last, since the run lasted as long as it did because of them.
+
+    :type test_runs: collections.Iterable[TestRun]
+    :type classifier: ServiceClassifier
+    :returns: the wall-clock time and the time on the critical path per
+        service, the busy time per worker, and the start and the end of the
+        run
+    :rtype: (dict[str, float], dict[str, float], dict[int, float], float,
+        float)
+    """
+    events = []
+    busy = collections.defaultdict(float)
+    worker_end = {}
+    worker_services = collections.defaultdict(
+        lambda: collections.defaultdict(float))
+    for test in test_runs:
+        service = classifier.classify(test.name)
+        events.append((test.end - test.duration, 1, service))
+        events.append((test.end, -1, service))
+        busy[test.worker] += test.duration
+        worker_end[test.worker] = max(worker_end.get(test.worker, test.end),
+                                      test.end)
+        worker_services[test.worker][service] += test.duration
+
+    wall_clock = collections.defaultdict(float)
+    if not events:
+        return wall_clock, {}, busy, 0.0, 0.0
+
+    # Ends come before starts at the same time, so that back to back tests
+    # of a worker do not overlap.
+    events.sort()
+    running = collections.Counter()
+    previous = events[0][0]
+    for event_time, change, service in events:
+        elapsed = event_time - previous
+        count = sum(running.values())
+        if elapsed > 0 and count:
+            for running_service, running_count in running.items():
+                wall_clock[running_service] += (elapsed * running_count
+                                                / count)
+        running[service] += change
+        if not running[service]:
+            del running[service]
+        previous = event_time
+
+    critical_worker = max(worker_end, key=worker_end.get)
+    return (wall_clock, dict(worker_services[critical_worker]), busy,
+            events[0][0], worker_end[critical_worker])
+
+
+class ServiceClassifier(object):
+    """
+    Tell which OpenStack service a test primarily tests, from its name.
+
+    All the fragments of the rules are compiled into a single regex, so that
+    a test name is scanned once whatever the number of rules. The service of
+    each test name is then remembered, since a run has a few thousand
+    different tests but each of them may appear several times.
+    """
+
+    def __init__(self, rules, default=DEFAULT_SERVICE):
+        """
+        :param rules: (fragment of test name, service) pairs, by decreasing
+            priority
+        :type rules: list[(str, str)]
+        :param default: service of the tests that match no rule
+        :type default: str
+        """
+        self.priorities = {}
+        self.services = {}
+        for priority, (fragment, service) in enumerate(rules):
+            self.priorities.setdefault(fragment, priority)
+            self.services.setdefault(fragment, service)
+        self.default = default
+        # The lookahead makes the matches overlap, e.g. '.api.compute.' and
+        # '.test_server_basic_ops.' share a dot. At a given position, the
+        # alternatives are tried in priority order.
+        self.regex = re.compile('(?=(%s))' % '|'.join(
+            re.escape(fragment) for fragment in
+            sorted(self.priorities, key=self.priorities.get)
+        ))
+        self.cache = {}
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        :param path: JSON file with a list of {"match": ..., "service": ...}
+            objects, by decreasing priority
+        :type path: str
+        :rtype: ServiceClassifier
+        """
+        with open(path) as rules_file:
+            rules = json.load(rules_file)
+        return cls([(rule['match'], rule['service']) for rule in rules])
+
+    def classify(self, test_name):
+        """
+        :type test_name: str
+        :rtype: str
+        """
+        try:
+            return self.cache[test_name]
+        except KeyError:
+            pass
+
+        fragments = [match.group(1)
+                     for match in self.regex.finditer(test_name)]
+        if fragments:
+            service = self.services[min(fragments, key=self.priorities.get)]
+        else:
+            service = self.default
+        self.cache[test_name] = service
+        return service
+
+
+DEFAULT_CLASSIFIER = ServiceClassifier(DEFAULT_RULES)
+
+
 def get_service_name_from_test_name(test_name):
     """
     Given a test name, returns which OpenStack service is primarily tested.
 
-    This is based partly on the location of the test in Tempest structure,
-    partly on the knowledge of the test itself.
-
     :type test_name: str
     :rtype: str
     """
-    nova_scenarios = [
-        '.test_server_advanced_ops.',
-        '.test_shelve_instance.',
-        '.test_server_basic_ops.'
-    ]
-    cinder_scenarios = [
-        '.test_snapshot_pattern.',
-        '.test_stamp_pattern.',
-        '.test_volume_boot_pattern.',
-    ]
-    if '.api.volume.' in test_name:
-        return 'cinder'
-    if '.api.compute.' in test_name:
-        return 'nova'
-    if any([scenario in test_name for scenario in nova_scenarios]):
-        return 'nova'
-    if any([scenario in test_name for scenario in cinder_scenarios]):
-        return 'cinder'
-    return 'other'
+    return DEFAULT_CLASSIFIER.classify(test_name)
+
+
+def get_test_records(location):
+    """
+    Get the name and the duration of all the tests of a run
+
+    :param location: URL or path of the console log of the run
+    :type location: str
+    :rtype: list[(str, float)]
+    """
+    return list(scan_test_names_and_durations(
+        decompress_chunks(iter_chunks(location))))
+
+
+def get_service_timings(records, classifier=DEFAULT_CLASSIFIER):
+    """
+    Sum the durations of the tests of a run per service
+
+    :param records: names and durations of the tests of the run
+    :type records: collections.Iterable[(str, float)]
+    :type classifier: ServiceClassifier
+    :rtype: dict[str, float]
+    """
+    timings = collections.defaultdict(float)
+    for name, duration in records:
+        timings[classifier.classify(name)] += duration
+    return timings
+
+
+def compress_chunks(chunks):
+    """
+    Gzip chunks of data as they come, unless the data is already gzipped
+
+    :type chunks: collections.Iterable[bytes]
+    :rtype: collections.Iterator[bytes]
+    """
+    chunks = iter(chunks)
+    compressor = None
+    for chunk in chunks:
+        if compressor is None:
+            if not chunk:
+                continue
+            if chunk.startswith(GZIP_MAGIC):
+                yield chunk
+                yield from chunks
+                return
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        yield compressor.compress(chunk)
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class LogCache(object):
+    """
+    On-disk cache of console logs and of the test records parsed from them.
+
+    Entries are named after a hash of the URL of the log and of its ETag and
+    Last-Modified headers (or of the path, size and modification time of a
+    local file), so a log that changes gets new entries. Logs are stored
+    gzipped. Local files are not copied, only their records are cached.
+
+    Reading an entry updates its modification time, and the least recently
+    used entries are removed when the cache grows larger than `max_size`
+    bytes. Logs returned by `get_log()` are pinned until `release()`, so that
+    a log waiting to be parsed is never removed.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        :type directory: str
+        :type max_size: int
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        # Number of users of each pinned entry, by path.
+        self.pinned = collections.Counter()
+        self.lock = threading.Lock()
+
+    def get_key(self, location):
+        """
+        :param location: URL or path of a log
+        :type location: str
+        :rtype: str
+        """
+        if is_url(location):
+            response = requests.head(location, allow_redirects=True)
+            response.raise_for_status()
+            parts = [location, response.headers.get('ETag', ''),
+                     response.headers.get('Last-Modified', '')]
+        else:
+            stat = os.stat(location)
+            parts = [os.path.realpath(location), str(stat.st_size),
+                     str(stat.st_mtime_ns)]
+        return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+    def _get_path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _write(self, path, chunks):
+        # Written under a temporary name, so that readers never see a
+        # partial entry.
+        entry = tempfile.NamedTemporaryFile(dir=self.directory,
+                                            suffix='.tmp', delete=False)
+        with entry:
+            for chunk in chunks:
+                entry.write(chunk)
+        os.replace(entry.name, path)
+        self.evict(keep=path)
+
+    def get_log(self, location, key):
+        """
+        Return the path of a log, downloading it in the cache if needed
+
+        The log stays in the cache at least until `release()` is called with
+        the same key.
+
+        :param location: URL or path of a log
+        :type location: str
+        :param key: key of the log, see `get_key()`
+        :type key: str
+        :rtype: str
+        """
+        if not is_url(location):
+            return location
+
+        path = self._get_path(key, '.log.gz')
+        with self.lock:
+            self.pinned[path] += 1
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            try:
+                self._write(path, compress_chunks(iter_chunks(location)))
+            except Exception:
+                self.release(key)
+                raise
+        return path
+
+    def release(self, key):
+        """
+        Allow the eviction of a log returned by `get_log()` again
+
+        :param key: key of the log, see `get_key()`
+        :type key: str
+        """
+        path = self._get_path(key, '.log.gz')
+        with self.lock:
+            self.pinned[path] -= 1
+            if self.pinned[path] <= 0:
+                del self.pinned[path]
+        self.evict()
+
+    def load_records(self, key):
+        """
+        :param key: key of a log, see `get_key()`
+        :type key: str
+        :returns: the cached records of the log, or None
+        :rtype: list[(str, float)]
+        """
+        path = self._get_path(key, '.json')
+        try:
+            with open(path) as records_file:
+                records = json.load(records_file)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return [(name, duration) for name, duration in records]
+
+    def save_records(self, key, records):
+        """
+        :param key: key of a log, see `get_key()`
+        :type key: str
+        :type records: list[(str, float)]
+        """
+        self._write(self._get_path(key, '.json'),
+                    [json.dumps(records).encode()])
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries beyond `max_size`
+
+        :param keep: path of an entry to keep anyway, like the one that was
+            just written
+        :type keep: str
+        """
+        with self.lock:
+            kept = set(self.pinned)
+        kept.add(keep)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp') or entry.path in kept:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def fetch_log(location, directory, cache=None):
+    """
+    Get a log ready to be parsed, or its already parsed records
+
+    :param location: URL or path of a log
+    :type location: str
+    :param directory: where remote logs are saved when there is no cache
+    :type directory: str
+    :type cache: LogCache
+    :returns: the cache key of the log (or None), the path of the log and its
+        cached records. Either the path or the records are None.
+    :rtype: (str, str, list[(str, float)])
+    """
+    if cache is not None:
+        key = cache.get_key(location)
+        records = cache.load_records(key)
+        if records is not None:
+            return key, None, records
+        return key, cache.get_log(location, key), None
+
+    if not is_url(location):
+        return None, location, None
+
+    log_file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    with log_file:
+        for chunk in iter_chunks(location):
+            log_file.write(chunk)
+    return None, log_file.name, None
+
+
+def load_test_records(location, cache=None):
+    """
+    Get the name and the duration of all the tests of a run, from the cache
+    if possible
+
+    :param location: URL or path of the console log of the run
+    :type location: str
+    :type cache: LogCache
+    :rtype: list[(str, float)]
+    """
+    if cache is None:
+        return get_test_records(location)
+
+    key, path, records = fetch_log(location, None, cache)
+    if records is None:
+        try:
+            records = get_test_records(path)
+        finally:
+            if path != location:
+                cache.release(key)
+        cache.save_records(key, records)
+    return records
+
+
+def iter_batch_test_records(locations, download_workers, parse_workers,
+                            cache=None):
+    """
+    Get the names and the durations of the tests of many runs
+
+    Logs are downloaded by a pool of threads and parsed by a pool of
+    processes, so that the network and all the CPUs are used at the same
+    time. Without a cache, downloaded logs are kept on disk only until they
+    are parsed.
+
+    :param locations: URLs or paths of the console logs of the runs
+    :type locations: list[str]
+    :type download_workers: int
+    :type parse_workers: int
+    :type cache: LogCache
+    :returns: the location and the records of each run that could be
+        analysed, in no particular order
+    :rtype: collections.Iterator[(str, list[(str, float)])]
+    """
+    with tempfile.TemporaryDirectory() as directory, \
+            futures.ThreadPoolExecutor(download_workers) as downloaders, \
+            futures.ProcessPoolExecutor(parse_workers) as parsers:
+        downloads = {
+            downloaders.submit(fetch_log, location, directory, cache): location
+            for location in locations
+        }
+        parses = {}
+        for download in futures.as_completed(downloads):
+            location = downloads[download]
+            try:
+                key, path, records = download.result()
+            except Exception as exc:
+                print("Failed to download %s: %r" % (location, exc),
+                      file=sys.stderr)
+                continue
+            if records is not None:
+                yield location, records
+            else:
+                parse = parsers.submit(get_test_records, path)
+                parses[parse] = (location, key, path)
+
+        for parse in futures.as_completed(parses):
+            location, key, path = parses[parse]
+            if cache is None and path != location:
+                os.remove(path)
+            elif cache is not None and path != location:
+                cache.release(key)
+            try:
+                records = parse.result()
+            except Exception as exc:
+                print("Failed to parse %s: %r" % (location, exc),
+                      file=sys.stderr)
+                continue
+            if cache is not None:
+                cache.save_records(key, records)
+            yield location, records
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list
+
+    :type sorted_values: list[float]
+    :type percent: float
+    :rtype: float
+    """
+    rank = max(int(round(percent / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize_runs(runs):
+    """
+    Compute the mean, median and 95th percentile of the time spent per
+    service, across the runs where the service was tested
+
+    :type runs: list[dict[str, float]]
+    :rtype: dict[str, (int, float, float, float)]
+    """
+    per_service = collections.defaultdict(list)
+    for timings in runs:
+        for service, duration in timings.items():
+            per_service[service].append(duration)
+
+    summary = {}
+    for service, durations in per_service.items():
+        durations.sort()
+        summary[service] = (len(durations), statistics.mean(durations),
+                            percentile(durations, 50),
+                            percentile(durations, 95))
+    return summary
+
+
+def print_wall_clock_profile(location, classifier, cache=None):
+    """
+    Print where the wall-clock time of a run went
+
+    :param location: URL or path of the console log of the run
+    :type location: str
+    :type classifier: ServiceClassifier
+    :type cache: LogCache
+    """
+    if cache is not None:
+        location = cache.get_log(location, cache.get_key(location))
+    test_runs = list(get_test_runs(get_log_lines(location)))
+    wall_clock, critical_path, busy, start, end = get_wall_clock_profile(
+        test_runs, classifier)
+    summed = get_service_timings(
+        ((test.name, test.duration) for test in test_runs), classifier)
+
+    print("{:<10} {:>12} {:>16} {:>18}".format(
+        "service", "summed (s)", "wall-clock (s)", "critical path (s)"))
+    for service in sorted(summed):
+        print("{:<10} {:>12.1f} {:>16.1f} {:>18.1f}".format(
+            service, summed[service], wall_clock.get(service, 0.0),
+            critical_path.get(service, 0.0)))
+
+    print()
+    print("{:<8} {:>10} {:>12}".format("worker", "busy (s)", "utilization"))
+    for worker, busy_time in sorted(busy.items()):
+        print("{:<8} {:>10.1f} {:>11.1f}%".format(
+            worker, busy_time, 100.0 * busy_time / ((end - start) or 1)))
+    print("%d tests on %d workers in %.1fs" % (len(test_runs), len(busy),
+                                               end - start))
+
+
+def print_trends(store, top):
+    """
+    Print the time spent per service and the tests whose duration increased
+    the most, over the runs of a store
+
+    :type store: timing_store.TimingStore
+    :param top: number of tests to print
+    :type top: int
+    """
+    columns = store.load_columns()
+    totals = store.get_service_totals(columns)
+    slopes = timing_store.get_trend(totals)
+    recent = totals[-10:].mean(axis=0) if len(totals) else totals.sum(axis=0)
+
+    print("{:<10} {:>10} {:>14} {:>18}".format(
+        "service", "mean (s)", "last 10 (s)", "trend (s/100 runs)"))
+    for service_id, service in sorted(enumerate(store.services.names),
+                                      key=lambda item: item[1]):
+        print("{:<10} {:>10.1f} {:>14.1f} {:>+18.1f}".format(
+            service, totals[:, service_id].mean(), recent[service_id],
+            slopes[service_id] * 100))
+
+    runs, means, slopes = store.get_test_trends(columns)
+    print()
+    print("{:<80} {:>6} {:>10} {:>18}".format(
+        "test", "runs", "mean (s)", "trend (s/100 runs)"))
+    for test_id in slopes.argsort()[::-1][:top]:
+        if slopes[test_id] <= 0:
+            break
+        print("{:<80} {:>6} {:>10.1f} {:>+18.1f}".format(
+            store.tests.names[test_id][:80], runs[test_id], means[test_id],
+            slopes[test_id] * 100))
+    print("%d runs in the store" % len(store.runs))
+
+
+def print_regressions(store, records, options):
+    """
+    Print the tests that got slower than in the runs of a store
+
+    :type store: timing_store.TimingStore
+    :type records: list[(str, float)]
+    :type options: argparse.Namespace
+    :returns: whether some tests regressed
+    :rtype: bool
+    """
+    regressions = timing_store.find_regressions(
+        store, records, options.margin, options.min_delta, options.min_runs)
+    print("{:<80} {:>6} {:>10} {:>10} {:>10}".format(
+        "test", "runs", "p50 (s)", "p95 (s)", "now (s)"))
+    for name, runs, p50, p95, now in regressions:
+        print("{:<80} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name[:80], runs, p50, p95, now))
+    print("%d test(s) regressed" % len(regressions))
+    return bool(regressions)
 
 
 def main():
-    """Print the run duration of all Cinder and Nova tests in Tempest."""
+    """Print the run duration of the tests in Tempest, per service."""
     parser = create_argument_parser()
     options = parser.parse_args()
 
-    timings = collections.defaultdict(float)
+    store = None
+    if options.store or options.trend or options.regressions:
+        if not options.store:
+            parser.error("--trend and --regressions require --store")
+        if timing_store is None:
+            parser.error("--store requires NumPy")
+        store = timing_store.TimingStore(options.store)
+    if options.trend:
+        print_trends(store, options.top)
+        return
+    if not options.console_logs:
+        parser.error("at least one console log is required")
+
+    if options.rules:
+        classifier = ServiceClassifier.from_file(options.rules)
+    else:
+        classifier = DEFAULT_CLASSIFIER
+
+    cache = None
+    if not options.no_cache:
+        cache = LogCache(options.cache_dir, options.cache_size * 1024 * 1024)
+
+    locations = expand_locations(options.console_logs)
+    if options.timeline:
+        if len(locations) != 1:
+            parser.error("--timeline requires a single console log")
+        print_wall_clock_profile(locations[0], classifier, cache)
+        return
+
+    if options.regressions:
+        if len(locations) == 1:
+            records = load_test_records(locations[0], cache)
+        else:
+            records = [
+                record for _, run_records in iter_batch_test_records(
+                    locations, options.download_workers,
+                    options.parse_workers, cache)
+                for record in run_records
+            ]
+        sys.exit(1 if print_regressions(store, records, options) else 0)
 
-    log_lines = get_log_lines(options.console_log)
-    for name, duration in get_test_names_and_durations(log_lines):
-        timings[get_service_name_from_test_name(name)] += duration
+    if len(locations) == 1:
+        records = load_test_records(locations[0], cache)
+        if store is not None:
+            store.add_runs([(locations[0], records)], classifier)
+        print(get_service_timings(records, classifier))
+        return
 
-    print(timings)
+    runs = []
+    stored_runs = []
+    for location, records in iter_batch_test_records(
+            locations, options.download_workers, options.parse_workers,
+            cache):
+        runs.append(get_service_timings(records, classifier))
+        if store is not None and not store.has_run(location):
+            stored_runs.append((location, records))
+    if store is not None:
+        # Runs are analysed in no particular order, but trends are computed
+        # in the order runs are added: keep the one of the command line.
+        order = {location: i for i, location in enumerate(locations)}
+        stored_runs.sort(key=lambda run: order[run[0]])
+        store.add_runs(stored_runs, classifier)
+    print("{:<10} {:>6} {:>10} {:>10} {:>10}".format(
+        "service", "runs", "mean (s)", "p50 (s)", "p95 (s)"))
+    for service, (count, mean, p50, p95) in sorted(
+            summarize_runs(runs).items()):
+        print("{:<10} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            service, count, mean, p50, p95))
+    print("%d of %d runs analysed" % (len(runs), len(locations)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,306 @@
+"""
+Columnar store of the test durations of many Tempest runs.
+
+A store is a directory holding:
+
+- `runs.json`, the location of each run, indexed by run id,
+- `tests.json` and `services.json`, the interned test and service names,
+  indexed by test id and service id,
+- `segment-NNNNNN.npz` files, each one with the `run`, `test`, `service` and
+  `duration` columns of the runs added at the same time.
+
+Adding runs writes a new segment instead of rewriting the existing ones, and
+queries load all the columns at once and aggregate them with NumPy.
+"""
+import glob
+import json
+import os
+import tempfile
+
+import numpy as np
+
+COLUMN_TYPES = {
+    'run': np.uint32,
+    'test': np.uint32,
+    'service': np.uint16,
+    'duration': np.float32,
+}
+
+
+def _save_json(path, data):
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp',
+                                     delete=False) as json_file:
+        json.dump(data, json_file)
+    os.replace(json_file.name, path)
+
+
+def _load_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return []
+
+
+class Interner(object):
+    """Give a stable integer id to each distinct string."""
+
+    def __init__(self, names):
+        """
+        :type names: list[str]
+        """
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def get_id(self, name):
+        """
+        :type name: str
+        :rtype: int
+        """
+        try:
+            return self.ids[name]
+        except KeyError:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            return self.ids[name]
+
+
+class TimingStore(object):
+    """Test durations of many Tempest runs, stored column by column."""
+
+    def __init__(self, directory):
+        """
+        :type directory: str
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.runs = _load_json(self._get_path('runs.json'))
+        self.tests = Interner(_load_json(self._get_path('tests.json')))
+        self.services = Interner(_load_json(self._get_path('services.json')))
+
+    def _get_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _get_segments(self):
+        return sorted(glob.glob(self._get_path('segment-*.npz')))
+
+    def has_run(self, location):
+        """
+        :type location: str
+        :rtype: bool
+        """
+        return location in self.runs
+
+    def add_runs(self, runs, classifier):
+        """
+        Add runs that are not in the store yet, as a new segment
+
+        :param runs: the location and the test records of each run
+        :type runs: collections.Iterable[(str, list[(str, float)])]
+        :param classifier: gives the service of each test
+        :type classifier: tempest_timing.ServiceClassifier
+        :returns: the number of runs added
+        :rtype: int
+        """
+        run_ids, test_ids, service_ids, durations = [], [], [], []
+        known_runs = set(self.runs)
+        added = 0
+        for location, records in runs:
+            if location in known_runs:
+                continue
+            known_runs.add(location)
+            run_id = len(self.runs)
+            self.runs.append(location)
+            added += 1
+            for name, duration in records:
+                run_ids.append(run_id)
+                test_ids.append(self.tests.get_id(name))
+                service_ids.append(
+                    self.services.get_id(classifier.classify(name)))
+                durations.append(duration)
+
+        if not added:
+            return 0
+
+        segment = self._get_path(
+            'segment-%06d.npz' % len(self._get_segments()))
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                         delete=False) as segment_file:
+            np.savez(segment_file,
+                     run=np.array(run_ids, dtype=COLUMN_TYPES['run']),
+                     test=np.array(test_ids, dtype=COLUMN_TYPES['test']),
+                     service=np.array(service_ids,
+                                      dtype=COLUMN_TYPES['service']),
+                     duration=np.array(durations,
+                                       dtype=COLUMN_TYPES['duration']))
+        os.replace(segment_file.name, segment)
+        # The names are saved after the segment that refers to them, so that
+        # the store is consistent even if we are interrupted in between.
+        _save_json(self._get_path('tests.json'), self.tests.names)
+        _save_json(self._get_path('services.json'), self.services.names)
+        _save_json(self._get_path('runs.json'), self.runs)
+        return added
+
+    def load_columns(self):
+        """
+        :returns: the run, test, service and duration columns of all the
+            segments, concatenated
+        :rtype: dict[str, numpy.ndarray]
+        """
+        columns = {name: [] for name in COLUMN_TYPES}
+        for path in self._get_segments():
+            with np.load(path) as segment:
+                for name, values in columns.items():
+                    values.append(segment[name])
+        return {
+            name: (np.concatenate(values) if values
+                   else np.array([], dtype=COLUMN_TYPES[name]))
+            for name, values in columns.items()
+        }
+
+    def get_service_totals(self, columns=None):
+        """
+        :returns: the time spent per service in each run, as a
+            (runs, services) matrix
+        :rtype: numpy.ndarray
+        """
+        if columns is None:
+            columns = self.load_columns()
+        n_services = len(self.services.names)
+        cells = (columns['run'].astype(np.int64) * n_services
+                 + columns['service'])
+        totals = np.bincount(cells, weights=columns['duration'],
+                             minlength=len(self.runs) * n_services)
+        return totals.reshape(len(self.runs), n_services)
+
+    def get_test_trends(self, columns=None):
+        """
+        Fit a line to the durations of each test over the runs it ran in
+
+        The sums the least squares fits need are computed for all the tests
+        at once by `numpy.bincount`.
+
+        :returns: the number of runs, the mean duration and the slope (the
+            change of duration per run) of each test, indexed by test id
+        :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        """
+        if columns is None:
+            columns = self.load_columns()
+        n_tests = len(self.tests.names)
+        test = columns['test']
+        x = columns['run'].astype(np.float64)
+        y = columns['duration'].astype(np.float64)
+
+        n = np.bincount(test, minlength=n_tests).astype(np.float64)
+        sum_x = np.bincount(test, weights=x, minlength=n_tests)
+        sum_y = np.bincount(test, weights=y, minlength=n_tests)
+        sum_xx = np.bincount(test, weights=x * x, minlength=n_tests)
+        sum_xy = np.bincount(test, weights=x * y, minlength=n_tests)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sum_y / n
+            denominator = n * sum_xx - sum_x * sum_x
+            slope = np.where(denominator > 0,
+                             (n * sum_xy - sum_x * sum_y) / denominator, 0.0)
+        return n.astype(np.int64), np.nan_to_num(mean), slope
+
+
+def get_trend(series):
+    """
+    Slope of the least squares line fit to each column of a matrix
+
+    :param series: a (points, series) matrix
+    :type series: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    if len(series) < 2:
+        return np.zeros(series.shape[1:])
+    x = np.arange(len(series), dtype=np.float64)
+    return np.polyfit(x, series, 1)[0]
+
+
+def get_grouped_percentile(groups, values, n_groups, percent):
+    """
+    Nearest-rank percentile of the values of each group, without a loop over
+    the groups
+
+    The values are sorted by group then by value once, after which the
+    percentile of a group is at a known offset from the start of the group.
+
+    :param groups: the group id of each value
+    :type groups: numpy.ndarray
+    :type values: numpy.ndarray
+    :param n_groups: number of groups, including empty ones
+    :type n_groups: int
+    :type percent: float
+    :returns: the percentile of each group (NaN for empty groups) and the
+        number of values of each group
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+
+    ranks = np.maximum(np.round(percent / 100.0 * counts).astype(np.int64), 1)
+    percentiles = np.full(n_groups, np.nan)
+    present = counts > 0
+    percentiles[present] = sorted_values[starts[present] + ranks[present] - 1]
+    return percentiles, counts
+
+
+def find_regressions(store, records, margin=0.2, min_delta=1.0,
+                     min_runs=5):
+    """
+    Find the tests that got slower than they used to be in a store
+
+    A test regressed if its median duration in `records` is more than
+    `margin` (a fraction) and more than `min_delta` seconds above the 95th
+    percentile of its durations in the store. Tests that ran in less than
+    `min_runs` runs of the store have no reliable baseline and are ignored.
+
+    :type store: TimingStore
+    :param records: names and durations of the tests of one or more runs
+    :type records: collections.Iterable[(str, float)]
+    :type margin: float
+    :type min_delta: float
+    :type min_runs: int
+    :returns: the name, the number of runs in the store, the baseline median
+        and 95th percentile and the new median duration of each test that
+        regressed, the worst first
+    :rtype: list[(str, int, float, float, float)]
+    """
+    test_ids, durations = [], []
+    for name, duration in records:
+        test_id = store.tests.ids.get(name)
+        if test_id is not None:
+            test_ids.append(test_id)
+            durations.append(duration)
+    if not test_ids:
+        return []
+
+    n_tests = len(store.tests.names)
+    columns = store.load_columns()
+    baseline_p50, baseline_runs = get_grouped_percentile(
+        columns['test'], columns['duration'], n_tests, 50)
+    baseline_p95, _ = get_grouped_percentile(
+        columns['test'], columns['duration'], n_tests, 95)
+    new_p50, new_runs = get_grouped_percentile(
+        np.array(test_ids, dtype=COLUMN_TYPES['test']),
+        np.array(durations, dtype=COLUMN_TYPES['duration']), n_tests, 50)
+
+    with np.errstate(invalid='ignore'):
+        regressed = ((new_runs > 0) & (baseline_runs >= min_runs)
+                     & (new_p50 > baseline_p95 * (1 + margin))
+                     & (new_p50 - baseline_p95 > min_delta))
+    regressed_ids = np.flatnonzero(regressed)
+    ratios = new_p50[regressed_ids] / np.maximum(
+        baseline_p95[regressed_ids], 1e-3)
+
+    return [
+        (store.tests.names[test_id], int(baseline_runs[test_id]),
+         float(baseline_p50[test_id]), float(baseline_p95[test_id]),
+         float(new_p50[test_id]))
+        for test_id in regressed_ids[np.argsort(-ratios)]
+    ]
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Compare the eventlet and the asyncio backends of vm_cleaner against a local
+fake compute API.
+
+The fake API serves paginated `servers/detail` listings for a number of
+regions, accepts server deletions and user lookups, and answers each request
+after `--latency` seconds, like a remote API would. Each backend runs a full
+sweep (listing, user lookups and deletions) in its own process, so that
+eventlet monkey-patching does not leak into the other backend.
+
+    $ ./bench_backends.py --regions 6 --servers 5000 --latency 0.05
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import vm_cleaner
+
+CREATED = '2016-01-01T00:00:00Z'
+
+
+class FakeComputeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Overridden by `serve()`.
+    latency = 0.0
+    servers_per_region = 0
+
+    def send_json(self, status, data=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def list_servers(self, region, query):
+        limit = int(query.get('limit', ['1000'])[0])
+        start = int(query.get('marker', ['-1'])[0]) + 1
+        stop = min(start + limit, self.servers_per_region)
+        base = 'http://%s:%d/%s' % (self.server.server_address + (region,))
+
+        servers = [{
+            'id': str(i),
+            'name': 'build-%d' % i if i % 2 else 'server-%d' % i,
+            'created': CREATED,
+            'user_id': 'user-%d' % (i % 50),
+            'status': 'ACTIVE',
+            'flavor': {'id': 'general1-%d' % (2 ** (i % 4))},
+            'links': [{'rel': 'self', 'href': '%s/servers/%d' % (base, i)}],
+        } for i in range(start, stop)]
+
+        page = {'servers': servers}
+        if stop < self.servers_per_region:
+            page['servers_links'] = [{
+                'rel': 'next',
+                'href': '%s/servers/detail?limit=%d&marker=%d' % (
+                    base, limit, stop - 1)
+            }]
+        return page
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[-2:] == ['servers', 'detail']:
+            self.send_json(200, self.list_servers(
+                parts[0], urllib.parse.parse_qs(url.query)))
+        elif parts[0] == 'users':
+            self.send_json(200, {'user': {'username': parts[1].upper()}})
+        else:
+            self.send_json(404, {})
+
+    def do_DELETE(self):
+        # Servers are not actually removed, so that each sweep sees the same
+        # servers.
+        time.sleep(self.latency)
+        self.send_json(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def serve(servers_per_region, latency):
+    FakeComputeHandler.latency = latency
+    FakeComputeHandler.servers_per_region = servers_per_region
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeComputeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_backend(args):
+    """Run one sweep with a backend and print its statistics as JSON."""
+    # All the fake regions share the same host, hence the same connection
+    # pool, which is sized for one region.
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+    vm_cleaner.OS_AUTH_URL = args.url
+    vm_cleaner.TOKEN_ID = 'fake-token'
+    compute_endpoints = {
+        'REGION%d' % i: '%s/REGION%d' % (args.url, i)
+        for i in range(args.regions)
+    }
+    sweep_args = argparse.Namespace(delete=True)
+    policy = vm_cleaner.Policy.from_duration(60)
+    user_cache = vm_cleaner.UserCache()
+    writer = vm_cleaner.OUTPUT_WRITERS['jsonl'](open(os.devnull, 'w'))
+
+    if args.backend == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+        vm_cleaner.SESSION = vm_cleaner.create_session(args.concurrency)
+        pool = eventlet.GreenPool(args.concurrency)
+        _, stats = vm_cleaner.sweep(sweep_args, compute_endpoints, pool,
+                                    policy, user_cache, writer)
+    else:
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        session = loop.run_until_complete(
+            vm_cleaner.create_async_session(args.concurrency))
+        _, stats = loop.run_until_complete(vm_cleaner.async_sweep(
+            sweep_args, compute_endpoints, session, policy, user_cache,
+            writer))
+        loop.run_until_complete(session.close())
+        loop.close()
+
+    print(json.dumps(stats))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the vm_cleaner backends against a local fake "
+                    "compute API.")
+    parser.add_argument("--regions", type=int, default=6,
+                        help="Number of regions. (default: 6)")
+    parser.add_argument("--servers", type=int, default=5000,
+                        help="Servers per region, half of them are deleted. "
+                             "(default: 5000)")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="Servers per listing page. (default: 1000)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds the fake API waits before answering "
+                             "each request. (default: 0.05)")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="Maximum number of concurrent requests. "
+                             "(default: 20)")
+    parser.add_argument("--backends", nargs='+',
+                        default=["eventlet", "asyncio"],
+                        choices=["eventlet", "asyncio"],
+                        help="Backends to compare. (default: both)")
+    # Internal: run one backend against an already running fake API.
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    vm_cleaner.PAGE_SIZE = args.page_size
+    if args.backend:
+        run_backend(args)
+        return
+
+    server = serve(args.servers, args.latency)
+    url = 'http://127.0.0.1:%d' % server.server_port
+    print("%d regions of %d servers, %d per page, %.3fs of latency, "
+          "%d concurrent requests" % (args.regions, args.servers,
+                                      args.page_size, args.latency,
+                                      args.concurrency))
+
+    for backend in args.backends:
+        start = time.monotonic()
+        output = subprocess.check_output([
+            sys.executable, __file__, '--backend', backend, '--url', url,
+            '--regions', str(args.regions), '--page-size',
+            str(args.page_size), '--concurrency', str(args.concurrency)
+        ])
+        elapsed = time.monotonic() - start
+        stats = json.loads(output.decode().splitlines()[-1])
+        print("{:<10} sweep {:>7.2f}s  total {:>7.2f}s  {:>6} servers  "
+              "{:>5} deleted  {:>3} failed".format(
+                  backend, stats['duration'], elapsed, stats['servers'],
+                  stats['deleted'], stats['failed_deletions']))
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ Dependencies:
 
     .. code:: shell
 
-        $ pip install eventlet humanize iso8601 requests tabulate
+        $ pip install aiohttp eventlet humanize iso8601 requests tabulate
 
 Note:
     - Authentication requires a Rackspace username and a Rackspace API key. In
@@ -18,6 +18,17 @@ Note:
       will be read by the program. This is the safest option because CLI
       arguments can be read by any users (e.g with the `ps aux` command) on a
       system.
+    - Which servers are old, and which of them are deleted, can be set per
+      name prefix, region and user id with a JSON rules file (`--rules`):
+
+      .. code:: json
+
+          [
+              {"max_age": 180},
+              {"prefix": "build-", "max_age": 180, "delete": true},
+              {"prefix": "build-", "region": "IAD", "max_age": 60,
+               "delete": true}
+          ]
 `
 Hacking:
     - Please run pep8 and pylint
@@ -27,32 +38,90 @@ TODO:
 """
 
 import argparse
+import asyncio
+import collections
+import csv
 import datetime
 import functools
+import itertools
+import json
 import logging
 import os
+import random
 import ssl
 import sys
+import time
 
-import eventlet
 import humanize
 import iso8601
 import requests
+from requests.packages.urllib3 import connectionpool
+from requests.packages.urllib3 import exceptions as urllib3_exc
+from requests.packages.urllib3.util import retry as urllib3_retry
 import tabulate
 
-eventlet.monkey_patch()
+try:
+    import aiohttp
+except ImportError:  # Only required by the asyncio backend
+    aiohttp = None
 
 OS_AUTH_URL = 'https://identity.api.rackspacecloud.com/v2.0'
 TOKEN_ID = None
+TOKEN_EXPIRES = None
+# In daemon mode, re-authenticate when the token expires in less than that.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=10)
+# Shared by all the green threads, so that connections (and TLS sessions) are
+# reused instead of being established for every single request.
+SESSION = None
+# As many slots as connections in the pool of the aiohttp session, see
+# `_async_req()`.
+ASYNC_REQUEST_SLOTS = None
+
+# Number of servers requested per page. Nova caps it to its `max_limit`
+# setting (1000 by default) anyway.
+PAGE_SIZE = 1000
+# Servers changed in the last seconds before a sync are listed again by the
+# next one, in case the clocks of the API nodes and ours slightly differ.
+CHANGES_SINCE_OVERLAP = datetime.timedelta(minutes=5)
+# Fields of a server that are kept in the state file of incremental syncs.
+SERVER_FIELDS = ('id', 'name', 'created', 'user_id', 'links', 'status',
+                 'flavor')
+# Columns of the old servers, in the order they are output.
+OLD_SERVER_FIELDS = ('name', 'region', 'owner', 'flavor', 'created', 'age',
+                     'hours')
+
+# Timeout, in seconds, to connect and then to receive each chunk of a
+# response. Set by `--request-timeout`.
+REQUEST_TIMEOUT = 4.0
+# Monotonic time after which no request is sent nor retried anymore. Set for
+# each sweep by `--deadline`.
+SWEEP_DEADLINE = None
+
+# Keep-alive timeout of the API servers, in seconds. Set by
+# `--server-idle-timeout`.
+SERVER_IDLE_TIMEOUT = 5.0
+# Connections idle for longer than the server idle timeout minus this margin
+# (in seconds) are not reused: the server may be closing them right now.
+IDLE_MARGIN = 1.0
+
+# HTTP errors with these status codes are retried, as well as 5xx ones. Other
+# 4xx errors will not go away by themselves.
+RETRY_STATUSES = (429,)
 
 EXC_TO_RETRY = (requests.exceptions.ConnectionError,
                 requests.exceptions.ReadTimeout,
+                requests.exceptions.HTTPError,
                 ssl.SSLError)
+AIO_EXC_TO_RETRY = (aiohttp.ClientConnectionError,
+                    aiohttp.ClientResponseError,
+                    asyncio.TimeoutError,
+                    ssl.SSLError) if aiohttp else ()
 
 # This mapping is used because listing all users in an organization
 # requires to be "admin" and we want this script to be usable by "simple"
 # users.
-# NOTE(Admin): update this mapping each time a new Rackspace user is created.
+# Users missing from this mapping are looked up in the identity API, which
+# works for the users we are allowed to see, and cached (see `UserCache`).
 USERID_TO_USERNAME = {
     '6d10dce340f941d7b5f62bdfabf690fc': 'jordan.pittier',
 }
@@ -74,33 +143,218 @@ class EnvDefault(argparse.Action):  # pylint: disable=R0903
         setattr(namespace, self.dest, values)
 
 
-def retry(excs, max_attempts=3):
+class DeadlineExceeded(Exception):
+    """The deadline of the sweep passed before a request could be sent."""
+
+
+def get_http_status(exc):
+    """Return the HTTP status code of an error response, or None."""
+    response = getattr(exc, 'response', None)
+    if response is not None:  # requests
+        return response.status_code
+    return getattr(exc, 'status', None)  # aiohttp
+
+
+def expire_token_if_unauthorized(exc):
+    """Make the next sweep get a new token if the current one was refused.
+
+    The token can be revoked before its expiry time: without this, the
+    daemon would keep sweeping with it until then.
+    """
+    global TOKEN_EXPIRES
+
+    if get_http_status(exc) == 401:
+        TOKEN_EXPIRES = None
+
+
+def is_retryable(exc):
+    status = get_http_status(exc)
+    return status is None or status >= 500 or status in RETRY_STATUSES
+
+
+def get_request_timeout():
+    """Return the timeout of the next request.
+
+    It is shortened so that the request does not outlive the deadline of the
+    sweep.
+    """
+    if SWEEP_DEADLINE is None:
+        return REQUEST_TIMEOUT
+    remaining = SWEEP_DEADLINE - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return min(REQUEST_TIMEOUT, remaining)
+
+
+def retry(excs, max_attempts=3, backoff=0.5, max_backoff=8.0, deadline=30.0):
     """Decorator to retry a function call if it raised a given exception.
 
+    HTTP errors are only retried if their status code says that the error
+    may be temporary (5xx and 429). Attempts are separated by an exponential
+    backoff with full jitter: a random delay between 0 and `backoff`, then
+    `2*backoff`, and so on up to `max_backoff` seconds.
+
     Args:
         excs: an exception or a tuple of exceptions
         max_attempts (int): the maximum number of times the function call
             should be retried.
+        backoff (float): the maximum delay before the first retry, in seconds
+        max_backoff (float): the maximum delay between two attempts
+        deadline (float): no attempt is made after this number of seconds
+            since the first one. Attempts are not made either after the
+            deadline of the sweep, if any.
     """
+    def get_delay(attempt, exc, start):
+        """Return the delay before the next attempt, or None to give up."""
+        if attempt == max_attempts-1 or not is_retryable(exc):
+            return None
+
+        delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+        retry_at = time.monotonic() + delay
+        if deadline is not None and retry_at - start > deadline:
+            return None
+        if SWEEP_DEADLINE is not None and retry_at > SWEEP_DEADLINE:
+            return None
+        return delay
+
     def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.monotonic()
+                for i in itertools.count():
+                    try:
+                        return await func(*args, **kwargs)
+                    except excs as exc:
+                        expire_token_if_unauthorized(exc)
+                        delay = get_delay(i, exc, start)
+                        if delay is None:
+                            raise
+                        logging.error("%s failed with %r, retrying in %.1fs",
+                                      func.__name__, exc, delay)
+                        await asyncio.sleep(delay)
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            for i in range(max_attempts):
+            start = time.monotonic()
+            for i in itertools.count():
                 try:
                     return func(*args, **kwargs)
                 except excs as exc:
-                    if i == max_attempts-1:
+                    expire_token_if_unauthorized(exc)
+                    delay = get_delay(i, exc, start)
+                    if delay is None:
                         raise
-                    else:
-                        if hasattr(func, 'func_name'):  # Python 2
-                            name = func.func_name
-                        else:   # Python 3
-                            name = func.__name__
-                        logging.error("%s failed with %r", name, exc)
+                    logging.error("%s failed with %r, retrying in %.1fs",
+                                  func.__name__, exc, delay)
+                    time.sleep(delay)
         return wrapper
     return decorate
 
 
+class StaleConnectionRetry(urllib3_retry.Retry):
+    """Retry policy that only retries idempotent requests whose connection
+    was closed by the server before it answered. Read timeouts and other
+    errors are left to `retry`.
+
+    This policy and the idle timeout pools below are a copy of the ones of
+    ospurge/ospurge/adapters.py, as this script is not installed with
+    ospurge: keep them in sync.
+    """
+    def __init__(self, total=1, **kwargs):
+        kwargs.setdefault('connect', 0)
+        kwargs.setdefault('read', total)
+        kwargs.setdefault('status', 0)
+        kwargs.setdefault('other', 0)
+        super().__init__(total=total, **kwargs)
+
+    def _is_read_error(self, err):
+        return isinstance(err, urllib3_exc.ProtocolError)
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  *args, **kwargs):
+        # Raised as is, `requests` turns it into a `ReadTimeout` rather than
+        # into a `ConnectionError`.
+        if isinstance(error, urllib3_exc.ReadTimeoutError):
+            raise error
+        return super().increment(method, url, response, error, *args,
+                                 **kwargs)
+
+
+class IdleTimeoutPoolMixin(object):
+    """Connection pool that discards the connections that have been idle for
+    too long instead of reusing them.
+    """
+    def __init__(self, *args, idle_timeout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.idle_timeout = idle_timeout
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        idle_since = getattr(conn, 'idle_since', None)
+        if (self.idle_timeout is None or idle_since is None or
+                time.monotonic() - idle_since < self.idle_timeout):
+            return conn
+
+        conn.close()
+        return self._new_conn()
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        super()._put_conn(conn)
+
+
+class IdleTimeoutHTTPConnectionPool(IdleTimeoutPoolMixin,
+                                    connectionpool.HTTPConnectionPool):
+    pass
+
+
+class IdleTimeoutHTTPSConnectionPool(IdleTimeoutPoolMixin,
+                                     connectionpool.HTTPSConnectionPool):
+    pass
+
+
+class IdleTimeoutAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter that does not reuse the connections that are about
+    to reach the keep-alive timeout of the server, and retries once the
+    idempotent requests sent on a connection the server closed anyway.
+
+    In daemon mode, connections stay idle for `--interval` between two
+    sweeps, which is usually longer than the keep-alive timeout.
+    """
+    def __init__(self, server_idle_timeout, **kwargs):
+        self.idle_timeout = max(server_idle_timeout - IDLE_MARGIN, 0)
+        kwargs.setdefault('max_retries', StaleConnectionRetry())
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(IdleTimeoutHTTPConnectionPool,
+                                      idle_timeout=self.idle_timeout),
+            'https': functools.partial(IdleTimeoutHTTPSConnectionPool,
+                                       idle_timeout=self.idle_timeout),
+        }
+
+
+def create_session(pool_size):
+    """Create a HTTP session able to keep `pool_size` connections per host.
+
+    Connections close to the keep-alive timeout of the server are not
+    reused, and idempotent requests sent on a kept-alive connection that the
+    server closed in the meantime are retried once.
+    """
+    session = requests.Session()
+    adapter = IdleTimeoutAdapter(SERVER_IDLE_TIMEOUT, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Content-type'] = 'application/json'
+    return session
+
+
+@retry(EXC_TO_RETRY, 3)
 def get_token(username, api_key):
     auth = {
         "RAX-KSKEY:apiKeyCredentials": {
@@ -108,14 +362,12 @@ def get_token(username, api_key):
             "apiKey": api_key
         }
     }
-    headers = {
-        'Content-type': 'application/json'
-    }
     data = {
         'auth': auth
     }
 
-    req = requests.post(OS_AUTH_URL + '/tokens', headers=headers, json=data)
+    req = SESSION.post(OS_AUTH_URL + '/tokens', json=data,
+                       timeout=get_request_timeout())
     req.raise_for_status()
 
     return req.json()
@@ -136,12 +388,12 @@ def list_compute_endpoints(service_catalog):
     return compute_endpoints
 
 
-def _req(method, url):
+def _req(method, url, params=None):
     headers = {
         'X-Auth-Token': TOKEN_ID,
-        'Content-type': 'application/json'
     }
-    req = requests.request(method, url, headers=headers, timeout=4.0)
+    req = SESSION.request(method, url, headers=headers, params=params,
+                          timeout=get_request_timeout())
     req.raise_for_status()
 
     logging.info("HTTP %s to %s took %d ms", method.upper(), req.url,
@@ -153,24 +405,129 @@ def _req(method, url):
 
 
 @retry(EXC_TO_RETRY, 3)
-def list_cloud_servers_by_endpoint(compute_endpoint):
+def _get_servers_page(url, params=None):
+    return _req('get', url, params)
+
+
+def list_cloud_servers_by_endpoint(compute_endpoint, changes_since=None):
+    """Yield all the servers of an endpoint, following the pagination links.
+
+    Args:
+        compute_endpoint (str): the Compute API URL of a region
+        changes_since (str): if set, only the servers that changed since
+            this ISO 8601 timestamp are listed, including deleted ones.
+    """
     url = "%s/servers/detail" % compute_endpoint
-    return _req('get', url)['servers']
+    params = {'limit': PAGE_SIZE}
+    if changes_since:
+        params['changes-since'] = changes_since
+
+    while url:
+        page = _get_servers_page(url, params)
+        for srv in page['servers']:
+            yield srv
+
+        # The "next" link already contains the query parameters
+        url, params = None, None
+        for link in page.get('servers_links', []):
+            if link['rel'] == 'next':
+                url = link['href']
+
+
+def sync_cloud_servers_by_endpoint(compute_endpoint, endpoint_state):
+    """List the servers of an endpoint incrementally.
+
+    Only the servers that changed since the previous sync are transferred,
+    and merged in `endpoint_state`, which is updated in place.
+
+    Returns:
+        list: all the servers of the endpoint
+    """
+    sync_start = datetime.datetime.now(tz=iso8601.iso8601.UTC)
+    changed_servers = list_cloud_servers_by_endpoint(
+        compute_endpoint, endpoint_state.get('changes_since'))
+    return merge_server_changes(endpoint_state, changed_servers, sync_start)
+
+
+def merge_server_changes(endpoint_state, changed_servers, sync_start):
+    """Merge the servers that changed since the previous sync of an endpoint.
+
+    Returns:
+        list: all the servers of the endpoint
+    """
+    known_servers = endpoint_state.setdefault('servers', {})
 
+    for srv in changed_servers:
+        if srv['status'] == 'DELETED':
+            known_servers.pop(srv['id'], None)
+        else:
+            known_servers[srv['id']] = {
+                field: srv[field] for field in SERVER_FIELDS if field in srv
+            }
 
-def list_all_cloud_servers(compute_endpoints):
-    servers = []
-    pool = eventlet.GreenPool()
+    endpoint_state['changes_since'] = (
+        sync_start - CHANGES_SINCE_OVERLAP).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return list(known_servers.values())
+
+
+def load_json(path):
+    """Load a JSON file, or return an empty dict if it does not exist."""
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_json(path, data):
+    """Atomically replace the content of a file with `data` as JSON."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(tmp_path, path)
+
+
+def list_all_cloud_servers(compute_endpoints, pool, state=None,
+                           failed_regions=None):
+    """Yield (region, server) tuples while the regions are being listed.
+
+    Servers are yielded as soon as their page is received, so that the
+    caller can process them without waiting for the slowest region. Once all
+    the servers of a region were yielded, (region, None) is yielded.
+
+    The regions that could not be listed are appended to `failed_regions`,
+    if given.
+    """
+    import eventlet.queue
+
+    queue = eventlet.queue.LightQueue()
 
     def worker(region, endpoint):
-        for srv in list_cloud_servers_by_endpoint(endpoint):
-            servers.append((region, srv))
+        try:
+            if state is None:
+                region_servers = list_cloud_servers_by_endpoint(endpoint)
+            else:
+                region_servers = sync_cloud_servers_by_endpoint(
+                    endpoint, state.setdefault(endpoint, {}))
+            for srv in region_servers:
+                queue.put((region, srv))
+        except Exception:  # pylint: disable=W0703
+            logging.exception("Failed to list the servers of region %s",
+                              region)
+            if failed_regions is not None:
+                failed_regions.append(region)
+        finally:
+            queue.put((region, None))
 
     for region, endpoint in compute_endpoints.items():
         pool.spawn(worker, region, endpoint)
 
-    pool.waitall()
-    return servers
+    remaining = len(compute_endpoints)
+    while remaining:
+        region, srv = queue.get()
+        if srv is None:
+            remaining -= 1
+        yield region, srv
 
 
 def get_server_creation_time_delta(server):
@@ -179,6 +536,71 @@ def get_server_creation_time_delta(server):
     return now - abs_created
 
 
+class Policy(object):
+    """Cleanup rules compiled into a prefix trie of server names.
+
+    A rule is a dict with a `max_age`, in minutes, after which a server is
+    considered old, and optionally a name `prefix`, a `region`, a `user_id`
+    and `delete` (whether old servers are deleted, false by default). The
+    rule that applies to a server is the one with the longest matching
+    prefix, then the most specific one on region and user id.
+
+    Finding it costs one trie step per character of the server name and at
+    most 4 dict lookups per step, however many rules there are.
+    """
+    RULE_KEYS = {'prefix', 'region', 'user_id', 'max_age', 'delete'}
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            unknown_keys = set(rule) - self.RULE_KEYS
+            if unknown_keys or not isinstance(rule.get('max_age'), int):
+                raise ValueError("Invalid rule %r" % rule)
+
+            node = self.root
+            for char in rule.get('prefix', ''):
+                node = node.setdefault(char, {})
+            # Single characters are the only other keys of a node.
+            node.setdefault('rules', {})[
+                (rule.get('region'), rule.get('user_id'))] = rule
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as rules_file:
+            return cls(json.load(rules_file))
+
+    @classmethod
+    def from_duration(cls, duration):
+        """The policy used without rules file: report all the servers older
+        than `duration` minutes, and only delete the ones named 'build-*'.
+        """
+        return cls([
+            {'max_age': duration},
+            {'prefix': 'build-', 'max_age': duration, 'delete': True},
+        ])
+
+    def match(self, region, server):
+        """Return the rule that applies to a server, or None."""
+        user_id = server.get('user_id')
+        keys = ((region, user_id), (region, None),
+                (None, user_id), (None, None))
+
+        best_rule = None
+        node = self.root
+        for char in itertools.chain(server['name'], [None]):
+            rules = node.get('rules')
+            if rules:
+                for key in keys:
+                    if key in rules:
+                        best_rule = rules[key]
+                        break
+            node = node.get(char)
+            if node is None:
+                break
+        return best_rule
+
+
+@retry(EXC_TO_RETRY, 3)
 def list_users():
     url = OS_AUTH_URL + '/users'
 
@@ -187,6 +609,158 @@ def list_users():
     }
 
 
+@retry(EXC_TO_RETRY, 3)
+def get_username(user_id):
+    """Return the username of a user, or None if we are not allowed to."""
+    url = '%s/users/%s' % (OS_AUTH_URL, user_id)
+    try:
+        return _req('get', url)['user']['username']
+    except requests.exceptions.HTTPError as exc:
+        if exc.response.status_code in (403, 404):
+            return None
+        raise
+
+
+class UserCache(object):
+    """A cache of usernames, by user id, optionally persisted to a file.
+
+    Usernames are looked up lazily, only for the user ids that are neither in
+    `USERID_TO_USERNAME` nor fresh in the cache. Users we are not allowed to
+    see are cached too, so that they are not looked up on every sweep. Failed
+    lookups are not cached, so that they are retried at the next sweep.
+    """
+
+    def __init__(self, path=None, ttl=24*60*60):
+        self.path = path
+        self.ttl = ttl
+        self.entries = load_json(path) if path else {}
+
+    def get(self, user_id):
+        if user_id in USERID_TO_USERNAME:
+            return USERID_TO_USERNAME[user_id]
+        entry = self.entries.get(user_id)
+        return entry and entry['username'] or 'Unknown'
+
+    def is_fresh(self, user_id):
+        entry = self.entries.get(user_id)
+        return entry is not None and time.time() - entry['fetched'] < self.ttl
+
+    def missing(self, user_ids):
+        """Return the user ids that are unknown or expired."""
+        return [user_id for user_id in set(user_ids)
+                if user_id not in USERID_TO_USERNAME
+                and not self.is_fresh(user_id)]
+
+    def update(self, usernames):
+        """Store (user_id, username) pairs looked up in the identity API."""
+        for user_id, username in usernames:
+            self.entries[user_id] = {
+                'username': username, 'fetched': time.time()
+            }
+
+        if self.path:
+            save_json(self.path, self.entries)
+
+    def resolve(self, user_ids, pool):
+        """Look up, concurrently, the users that are unknown or expired."""
+        missing = self.missing(user_ids)
+        if not missing:
+            return
+
+        def lookup(user_id):
+            try:
+                return user_id, get_username(user_id)
+            except (requests.exceptions.RequestException, ssl.SSLError,
+                    DeadlineExceeded) as e:
+                logging.error("Failed to look up user %s: %r", user_id, e)
+                return None
+
+        self.update(pair for pair in pool.imap(lookup, missing)
+                    if pair is not None)
+
+
+class TableWriter(object):
+    """Print the old servers of a sweep as a table once the sweep is over."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.rows = []
+
+    def write(self, old_server):
+        self.rows.append(old_server)
+
+    def end_sweep(self):
+        if self.rows:
+            print(tabulate.tabulate(self.rows, headers="keys"),
+                  file=self.stream)
+        self.rows = []
+
+
+class JSONLinesWriter(object):
+    """Write each old server as a JSON object on its own line."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, old_server):
+        self.stream.write(json.dumps(old_server) + '\n')
+
+    def end_sweep(self):
+        self.stream.flush()
+
+
+class CSVWriter(object):
+    """Write each old server as a CSV row, after a header row."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.DictWriter(stream, OLD_SERVER_FIELDS)
+        self.writer.writeheader()
+
+    def write(self, old_server):
+        self.writer.writerow(old_server)
+
+    def end_sweep(self):
+        self.stream.flush()
+
+
+OUTPUT_WRITERS = {
+    'table': TableWriter,
+    'jsonl': JSONLinesWriter,
+    'csv': CSVWriter,
+}
+
+
+class CostReport(object):
+    """Count the old servers and their VM-hours per owner, region and flavor.
+
+    The totals are updated as the old servers are found, so that the servers
+    themselves do not need to be kept.
+    """
+
+    def __init__(self):
+        self.totals = collections.defaultdict(lambda: [0, 0.0])
+
+    def add(self, old_server):
+        total = self.totals[
+            (old_server['owner'], old_server['region'], old_server['flavor'])
+        ]
+        total[0] += 1
+        total[1] += old_server['hours']
+
+    @property
+    def vm_hours(self):
+        return sum(hours for _, hours in self.totals.values())
+
+    def to_dict(self):
+        rows = [{
+            'owner': owner, 'region': region, 'flavor': flavor,
+            'servers': count, 'vm_hours': round(hours, 1)
+        } for (owner, region, flavor), (count, hours) in self.totals.items()]
+        rows.sort(key=lambda row: row['vm_hours'], reverse=True)
+        return {'vm_hours': round(self.vm_hours, 1), 'groups': rows}
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Look for old VMs and optionnaly delete them.")
@@ -196,7 +770,67 @@ def parse_args():
                         help="Delete old VMs instead of just listing them")
     parser.add_argument("--duration", required=False, default=3*60, type=int,
                         help="Duration, in minutes, after which a VM is "
-                             "considered old. (default: 180)")
+                             "considered old. Ignored with --rules. "
+                             "(default: 180)")
+    parser.add_argument("--rules", metavar="PATH",
+                        help="JSON file with a list of cleanup rules, each "
+                             "with a 'max_age' in minutes, and optionally a "
+                             "name 'prefix', a 'region', a 'user_id' and "
+                             "'delete'. Replaces --duration and the 'build-' "
+                             "prefix of deleted servers.")
+    parser.add_argument("--format", choices=sorted(OUTPUT_WRITERS),
+                        default="table",
+                        help="Output format of the old servers. 'jsonl' and "
+                             "'csv' are written as each region is listed, "
+                             "'table' once all the regions are. "
+                             "(default: table)")
+    parser.add_argument("--cost-report", metavar="PATH",
+                        help="Write the number of old servers and the "
+                             "VM-hours they ran for, per owner, region and "
+                             "flavor, to this JSON file after each sweep.")
+    parser.add_argument("--backend", choices=["eventlet", "asyncio"],
+                        default="eventlet",
+                        help="Run the HTTP requests concurrently with "
+                             "eventlet green threads, or with asyncio and "
+                             "aiohttp. (default: eventlet)")
+    parser.add_argument("--concurrency", default=20, type=int, metavar="N",
+                        help="Maximum number of concurrent HTTP requests. "
+                             "(default: 20)")
+    parser.add_argument("--request-timeout", default=4.0, type=float,
+                        metavar="SECONDS",
+                        help="Timeout to connect to the API, then to receive "
+                             "each part of a response. (default: 4)")
+    parser.add_argument("--server-idle-timeout", default=5.0, type=float,
+                        metavar="SECONDS",
+                        help="Keep-alive timeout of the API servers. Pooled "
+                             "connections are not reused when they are about "
+                             "to reach it. (default: 5)")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS",
+                        help="Stop sending and retrying requests this long "
+                             "after the start of a sweep, so that a sweep "
+                             "never lasts much longer. (default: none)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and sweep all the regions every "
+                             "--interval seconds, reusing the token and the "
+                             "HTTP connections between sweeps.")
+    parser.add_argument("--interval", default=5*60, type=int,
+                        metavar="SECONDS",
+                        help="Time between the start of two sweeps in daemon "
+                             "mode. (default: 300)")
+    parser.add_argument("--stats-file", metavar="PATH",
+                        help="Write the duration and the counts of the last "
+                             "sweep to this JSON file after each sweep.")
+    parser.add_argument("--user-cache", metavar="PATH",
+                        help="Keep the usernames looked up in the identity "
+                             "API in this file.")
+    parser.add_argument("--user-cache-ttl", default=24*60*60, type=int,
+                        metavar="SECONDS",
+                        help="Time after which a cached username is looked up "
+                             "again. (default: 86400)")
+    parser.add_argument("--state-file", metavar="PATH",
+                        help="Keep the list of servers in this file and, on "
+                             "the next runs, only fetch the servers that "
+                             "changed since the previous run.")
     parser.add_argument("--rax-username", action=EnvDefault,
                         envvar='RAX_USERNAME', required=True,
                         help="Rackspace Cloud username (e.g rayenebenrayana). "
@@ -209,22 +843,351 @@ def parse_args():
     return parser.parse_args()
 
 
-def delete_server_if_name_matches(server):
+@retry(EXC_TO_RETRY, 3)
+def _delete_server_by_url(url):
+    try:
+        _req('delete', url)
+    except requests.exceptions.HTTPError as exc:
+        # Already gone, maybe deleted by an attempt whose response was lost.
+        if exc.response.status_code != 404:
+            raise
+
+
+def delete_server(server):
     def get_server_url(server):
         for link in server['links']:
             if link['rel'] == 'self':
                 return link['href']
         raise AttributeError("No URL to server found.")
 
-    if server['name'].startswith('build-'):
-        url = get_server_url(server)
-        logging.info('Going to delete server %s at %s',
-                     server['name'], url)
-        _req('delete', url)
+    url = get_server_url(server)
+    logging.info('Going to delete server %s at %s',
+                 server['name'], url)
+    try:
+        _delete_server_by_url(url)
+    except (requests.exceptions.RequestException, ssl.SSLError,
+            DeadlineExceeded) as exc:
+        logging.error("Failed to delete server %s: %r",
+                      server['name'], exc)
+        return False
+    return True
 
 
-def main():
+def authenticate(args):
+    """Get a new token and return the compute endpoints of its catalog."""
     global TOKEN_ID
+    global TOKEN_EXPIRES
+
+    token = get_token(args.rax_username, args.rax_api_key)
+    TOKEN_ID = token['access']['token']['id']
+    TOKEN_EXPIRES = iso8601.parse_date(token['access']['token']['expires'])
+
+    service_catalog = get_service_catalog_from_token(token)
+    return list_compute_endpoints(service_catalog)
+
+
+def token_expires_soon():
+    now = datetime.datetime.now(tz=iso8601.iso8601.UTC)
+    return TOKEN_EXPIRES is None or TOKEN_EXPIRES - now < TOKEN_REFRESH_MARGIN
+
+
+def check_server(args, policy, region, srv):
+    """Apply the cleanup policy to a server.
+
+    Returns:
+        tuple: the report entry of the server if it is old (or None), and
+            whether it must be deleted.
+    """
+    rule = policy.match(region, srv)
+    if rule is None:
+        return None, False
+
+    age = get_server_creation_time_delta(srv)
+    if age.total_seconds() <= rule['max_age']*60:
+        return None, False
+
+    old_server = {
+        'name': srv['name'],
+        'region': region,
+        # Replaced by the username once the users of the region are resolved.
+        'owner': srv['user_id'],
+        'flavor': srv.get('flavor', {}).get('id'),
+        'created': srv['created'],
+        'age': humanize.naturaltime(age),
+        'hours': round(age.total_seconds() / 3600, 1),
+    }
+    return old_server, bool(args.delete and rule.get('delete'))
+
+
+def output_old_servers(old_servers, user_cache, writer, cost_report):
+    """Set the owner names of the old servers of a region and output them."""
+    for srv in old_servers:
+        srv['owner'] = user_cache.get(srv['owner'])
+        writer.write(srv)
+        cost_report.add(srv)
+
+
+def finish_sweep(started_at, start, compute_endpoints, failed_regions,
+                 servers_count, cost_report, deletion_results, writer):
+    """Compute the statistics of a sweep."""
+    writer.end_sweep()
+    deleted = sum(1 for result in deletion_results if result)
+    return {
+        'started_at': started_at.isoformat(),
+        'duration': time.monotonic() - start,
+        'regions': len(compute_endpoints),
+        'failed_regions': len(failed_regions),
+        'servers': servers_count,
+        'old_servers': sum(count for count, _ in cost_report.totals.values()),
+        'vm_hours': round(cost_report.vm_hours, 1),
+        'deleted': deleted,
+        'failed_deletions': len(deletion_results) - deleted,
+    }
+
+
+def sweep(args, compute_endpoints, pool, policy, user_cache, writer,
+          state=None):
+    """List the servers of all the regions and delete the old ones if asked.
+
+    The old servers of each region are given to `writer` as soon as the
+    region is listed and their owners are resolved.
+
+    Returns:
+        tuple: the `CostReport` of the old servers and a dict of statistics
+            about the sweep.
+    """
+    started_at = datetime.datetime.now(tz=iso8601.iso8601.UTC)
+    start = time.monotonic()
+    servers_count = 0
+    old_servers = collections.defaultdict(list)
+    cost_report = CostReport()
+    deletions = []
+    failed_regions = []
+
+    for region, srv in list_all_cloud_servers(compute_endpoints, pool, state,
+                                              failed_regions):
+        if srv is None:
+            region_old_servers = old_servers.pop(region, [])
+            user_cache.resolve([s['owner'] for s in region_old_servers], pool)
+            output_old_servers(region_old_servers, user_cache, writer,
+                               cost_report)
+            continue
+
+        servers_count += 1
+        old_server, must_delete = check_server(args, policy, region, srv)
+        if old_server:
+            old_servers[region].append(old_server)
+        if must_delete:
+            deletions.append(pool.spawn(delete_server, srv))
+
+    deletion_results = [deletion.wait() for deletion in deletions]
+
+    stats = finish_sweep(started_at, start, compute_endpoints, failed_regions,
+                         servers_count, cost_report, deletion_results, writer)
+    return cost_report, stats
+
+
+# The asyncio backend. It relies on aiohttp instead of eventlet and requests,
+# and does the same as the functions above.
+
+async def create_async_session(pool_size):
+    global ASYNC_REQUEST_SLOTS
+    ASYNC_REQUEST_SLOTS = asyncio.Semaphore(pool_size)
+    # aiohttp closes the connections idle for longer than `keepalive_timeout`
+    # itself, and already retries idempotent requests on stale connections.
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=pool_size,
+            keepalive_timeout=max(SERVER_IDLE_TIMEOUT - IDLE_MARGIN, 0)),
+        headers={'Content-type': 'application/json'},
+    )
+
+
+async def _async_req(session, method, url, params=None):
+    headers = {
+        'X-Auth-Token': TOKEN_ID,
+    }
+    # Wait for a free connection of the pool before checking the deadline:
+    # otherwise the queued requests would all pass the check, then be sent
+    # whenever a connection frees up. Like the timeout of `requests`, the
+    # timeout does not include that wait either.
+    async with ASYNC_REQUEST_SLOTS:
+        timeout = get_request_timeout()
+        start = time.monotonic()
+        async with session.request(
+                method, url, headers=headers, params=params,
+                timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=timeout, sock_read=timeout)
+        ) as resp:
+            resp.raise_for_status()
+
+            logging.info("HTTP %s to %s took %d ms", method.upper(),
+                         resp.url, (time.monotonic() - start) * 1000)
+
+            # "204 No Content" has obviously no body
+            if resp.status != 204:
+                return await resp.json()
+
+
+@retry(AIO_EXC_TO_RETRY, 3)
+async def _async_get_servers_page(session, url, params=None):
+    return await _async_req(session, 'get', url, params)
+
+
+async def async_list_cloud_servers_by_endpoint(session, compute_endpoint,
+                                               on_page, changes_since=None):
+    """Call `on_page` with each page of servers of an endpoint.
+
+    Pages can only be requested one after the other, since each one gives
+    the link to the next one. The next page is requested before `on_page`
+    is called, so that its transfer overlaps the processing of the current
+    one.
+    """
+    url = "%s/servers/detail" % compute_endpoint
+    params = {'limit': PAGE_SIZE}
+    if changes_since:
+        params['changes-since'] = changes_since
+
+    next_page = asyncio.ensure_future(
+        _async_get_servers_page(session, url, params))
+    while next_page is not None:
+        page = await next_page
+
+        # The "next" link already contains the query parameters
+        next_page = None
+        for link in page.get('servers_links', []):
+            if link['rel'] == 'next':
+                next_page = asyncio.ensure_future(
+                    _async_get_servers_page(session, link['href']))
+
+        on_page(page['servers'])
+
+
+@retry(AIO_EXC_TO_RETRY, 3)
+async def async_get_username(session, user_id):
+    url = '%s/users/%s' % (OS_AUTH_URL, user_id)
+    try:
+        return (await _async_req(session, 'get', url))['user']['username']
+    except aiohttp.ClientResponseError as exc:
+        if exc.status in (403, 404):
+            return None
+        raise
+
+
+@retry(AIO_EXC_TO_RETRY, 3)
+async def _async_delete_server_by_url(session, url):
+    try:
+        await _async_req(session, 'delete', url)
+    except aiohttp.ClientResponseError as exc:
+        # Already gone, maybe deleted by an attempt whose response was lost.
+        if exc.status != 404:
+            raise
+
+
+async def async_delete_server(session, server):
+    url = [link['href'] for link in server['links']
+           if link['rel'] == 'self'][0]
+    logging.info('Going to delete server %s at %s', server['name'], url)
+    try:
+        await _async_delete_server_by_url(session, url)
+    except AIO_EXC_TO_RETRY + (DeadlineExceeded,) as exc:
+        logging.error("Failed to delete server %s: %r", server['name'], exc)
+        return False
+    return True
+
+
+async def async_resolve_users(session, user_cache, user_ids):
+    """Same as `UserCache.resolve()`, with asyncio tasks."""
+    async def lookup(user_id):
+        try:
+            return user_id, await async_get_username(session, user_id)
+        except AIO_EXC_TO_RETRY + (DeadlineExceeded,) as e:
+            logging.error("Failed to look up user %s: %r", user_id, e)
+            return None
+
+    missing_users = user_cache.missing(user_ids)
+    if missing_users:
+        pairs = await asyncio.gather(
+            *[lookup(user_id) for user_id in missing_users])
+        user_cache.update(pair for pair in pairs if pair is not None)
+
+
+async def async_sweep(args, compute_endpoints, session, policy, user_cache,
+                      writer, state=None):
+    """Same as `sweep()`, with all the regions, the pages of the regions and
+    the deletions processed concurrently by asyncio tasks.
+    """
+    started_at = datetime.datetime.now(tz=iso8601.iso8601.UTC)
+    start = time.monotonic()
+    servers_count = 0
+    old_servers = collections.defaultdict(list)
+    cost_report = CostReport()
+    deletions = []
+    failed_regions = []
+
+    queue = asyncio.Queue()
+
+    async def worker(region, endpoint):
+        try:
+            if state is None:
+                await async_list_cloud_servers_by_endpoint(
+                    session, endpoint,
+                    lambda servers: queue.put_nowait((region, servers)))
+            else:
+                endpoint_state = state.setdefault(endpoint, {})
+                sync_start = datetime.datetime.now(tz=iso8601.iso8601.UTC)
+                changed_servers = []
+                await async_list_cloud_servers_by_endpoint(
+                    session, endpoint, changed_servers.extend,
+                    endpoint_state.get('changes_since'))
+                queue.put_nowait((region, merge_server_changes(
+                    endpoint_state, changed_servers, sync_start)))
+        except Exception:  # pylint: disable=W0703
+            logging.exception("Failed to list the servers of region %s",
+                              region)
+            failed_regions.append(region)
+        finally:
+            queue.put_nowait((region, None))
+
+    # The event loop only keeps weak references to the tasks.
+    workers = [asyncio.ensure_future(worker(region, endpoint))
+               for region, endpoint in compute_endpoints.items()]
+
+    remaining = len(compute_endpoints)
+    while remaining:
+        region, servers = await queue.get()
+        if servers is None:
+            remaining -= 1
+            region_old_servers = old_servers.pop(region, [])
+            await async_resolve_users(
+                session, user_cache, [s['owner'] for s in region_old_servers])
+            output_old_servers(region_old_servers, user_cache, writer,
+                               cost_report)
+            continue
+
+        for srv in servers:
+            servers_count += 1
+            old_server, must_delete = check_server(args, policy, region, srv)
+            if old_server:
+                old_servers[region].append(old_server)
+            if must_delete:
+                deletions.append(asyncio.ensure_future(
+                    async_delete_server(session, srv)))
+
+    await asyncio.gather(*workers)
+    deletion_results = await asyncio.gather(*deletions)
+
+    stats = finish_sweep(started_at, start, compute_endpoints, failed_regions,
+                         servers_count, cost_report, deletion_results, writer)
+    return cost_report, stats
+
+
+def main():
+    global SESSION
+    global REQUEST_TIMEOUT
+    global SERVER_IDLE_TIMEOUT
+    global SWEEP_DEADLINE
+    global TOKEN_EXPIRES
 
     args = parse_args()
 
@@ -233,39 +1196,91 @@ def main():
         format='%(levelname)s:%(name)s:%(asctime)s:%(message)s',
         level=log_level
     )
+    REQUEST_TIMEOUT = args.request_timeout
+    SERVER_IDLE_TIMEOUT = args.server_idle_timeout
 
-    token = get_token(args.rax_username, args.rax_api_key)
-    service_catalog = get_service_catalog_from_token(token)
-    compute_endpoints = list_compute_endpoints(service_catalog)
+    if args.backend == 'eventlet':
+        # Only patch when eventlet is actually used, and before any socket or
+        # lock of the session is created.
+        import eventlet
+        eventlet.monkey_patch()
+        pool = eventlet.GreenPool(args.concurrency)
+    elif aiohttp is None:
+        sys.exit("The asyncio backend requires aiohttp")
+    else:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        aio_session = loop.run_until_complete(
+            create_async_session(args.concurrency))
 
-    TOKEN_ID = token['access']['token']['id']
+    SESSION = create_session(args.concurrency)
+    compute_endpoints = authenticate(args)
+
+    user_cache = UserCache(args.user_cache, args.user_cache_ttl)
+    if args.rules:
+        policy = Policy.from_file(args.rules)
+    else:
+        policy = Policy.from_duration(args.duration)
+    state = load_json(args.state_file) if args.state_file else None
+    writer = OUTPUT_WRITERS[args.format](sys.stdout)
 
-    # Uncomment the following line to print the current `USERID_TO_USERNAME`
-    # mapping. You need to have an admin token to do that.
-    # import pprint; pprint.pprint(list_users())
-
-    def get_and_process_old_servers(compute_endpoints):
-        old_servers = []
-        for region, srv in list_all_cloud_servers(compute_endpoints):
-            if get_server_creation_time_delta(srv).seconds > args.duration*60:
-                old_servers.append({
-                    'name': srv['name'],
-                    'region': region,
-                    'owner': USERID_TO_USERNAME.get(srv['user_id'], 'Unknown'),
-                    'created': humanize.naturaltime(
-                        get_server_creation_time_delta(srv))
-                })
-                if args.delete:
-                    delete_server_if_name_matches(srv)
-
-        return old_servers
-
-    old_servers = get_and_process_old_servers(compute_endpoints)
-    if old_servers:
-        print(tabulate.tabulate(old_servers, headers="keys"))
+    while True:
+        try:
+            # The endpoints only change with the token they come from.
+            if token_expires_soon():
+                compute_endpoints = authenticate(args)
 
+            if args.deadline:
+                SWEEP_DEADLINE = time.monotonic() + args.deadline
+
+            if args.backend == 'eventlet':
+                cost_report, stats = sweep(args, compute_endpoints, pool,
+                                           policy, user_cache, writer, state)
+            else:
+                cost_report, stats = loop.run_until_complete(async_sweep(
+                    args, compute_endpoints, aio_session, policy,
+                    user_cache, writer, state))
+        except KeyboardInterrupt:
+            break
+        except Exception:
+            SWEEP_DEADLINE = None
+            # Get a new token in case this one caused the failure.
+            TOKEN_EXPIRES = None
+            if not args.daemon:
+                raise
+            logging.exception("Sweep failed, will retry in %d seconds",
+                              args.interval)
+            time.sleep(args.interval)
+            continue
+
+        SWEEP_DEADLINE = None
+        if args.state_file:
+            save_json(args.state_file, state)
+        if args.stats_file:
+            save_json(args.stats_file, stats)
+        if args.cost_report:
+            save_json(args.cost_report, cost_report.to_dict())
+
+        logging.warning(
+            "Sweep of %(regions)d regions (%(failed_regions)d failed) took "
+            "%(duration).1fs: "
+            "%(servers)d servers, %(old_servers)d old (%(vm_hours).1f "
+            "VM-hours), %(deleted)d deleted, %(failed_deletions)d failed "
+            "deletions", stats)
+
+        if not args.daemon:
+            break
+        try:
+            time.sleep(max(args.interval - stats['duration'], 0))
+        except KeyboardInterrupt:
+            break
+
+    if args.backend == 'asyncio':
+        loop.run_until_complete(aio_session.close())
+        loop.close()
     sys.exit(0)
 
+
 if __name__ == "__main__":
     logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
     requests.packages.urllib3.disable_warnings()